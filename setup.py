@@ -15,15 +15,12 @@ setup(name="van.static",
       author="Vanguardistas LLC",
       description="Tools for managing Pyramid static files on a CDN",
       test_suite="van.static.tests",
-      namespace_packages=["van"],
       tests_require = ['mock'],
       install_requires = [
           'setuptools',
           'pyramid',
           ],
       classifiers=[
-          'Programming Language :: Python :: 2.5',
-          'Programming Language :: Python :: 2.6',
           'Programming Language :: Python :: 2.7',
           'Programming Language :: Python :: 3',
           'Programming Language :: Python :: 3.2',
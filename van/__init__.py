@@ -1,3 +1,2 @@
 # this is a namespace package
-import pkg_resources
-pkg_resources.declare_namespace(__name__)
+__path__ = __import__('pkgutil').extend_path(__path__, __name__)
@@ -0,0 +1,35 @@
+"""Access to package resources and metadata without importing pkg_resources.
+
+Importing pkg_resources scans every installed distribution, so it is only
+imported as a fallback on Pythons without ``importlib.resources.files``.
+"""
+
+
+def files(package):
+    """Return the ``importlib.resources`` Traversable of ``package``.
+
+    Returns None on Pythons before 3.9 and for resources next to a module
+    which is not a package, callers then use pkg_resources.
+    """
+    try:
+        from importlib.resources import files
+    except ImportError:
+        return None
+    try:
+        return files(package)
+    except (TypeError, ImportError):
+        # TypeError: 'mymod' is not a package
+        return None
+
+
+def entry_points(group):
+    """Return the entry points registered in ``group``."""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        from pkg_resources import iter_entry_points
+        return list(iter_entry_points(group))
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=group))
+    return list(eps.get(group, ()))
@@ -1,18 +1,20 @@
+# Modules only needed by either the add_cdn_view directive (pyramid) or the
+# extraction (cssutils, zipfile, gzip, optparse, ...) are imported where they
+# are used, so application processes and the extract command only pay for
+# what they use.
 import os
+import re
+import posixpath
 import sys
-import gzip
 import shutil
+import time
 import base64
+import json
 import logging
-import optparse
-import mimetypes
+import threading
 import subprocess
-from tempfile import mkdtemp, mkstemp
-
-try:
-    import cssutils
-except ImportError:
-    cssutils = None
+from tempfile import mkdtemp, mkstemp, SpooledTemporaryFile
+from collections import deque
 
 try:
     from urllib.parse import urlparse
@@ -20,17 +22,26 @@ except ImportError:
     #python 2
     from urlparse import urlparse
 
-from pyramid.static import resolve_asset_spec
-from pkg_resources import (get_distribution, resource_listdir, resource_isdir,
-                           resource_filename)
+from van.static import _compat
 
 _PY3 = sys.version_info[0] == 3
 
+_CHUNK_SIZE = 64 * 1024
+# encoded files larger than this are spooled to disk
+_SPOOL_SIZE = 1024 * 1024
+# S3 multipart uploads: smallest part S3 allows, attempts per part and
+# parts uploaded at the same time
+_MIN_PART_SIZE = 5 * 1024 * 1024
+_PART_RETRIES = 3
+_PART_JOBS = 4
+
 def includeme(config):
+    from van.static.yui import add_yui_combo_view
     config.add_directive('add_cdn_view', add_cdn_view)
+    config.add_directive('add_yui_combo_view', add_yui_combo_view)
 
 
-def add_cdn_view(config, name, path, encodings=()):
+def add_cdn_view(config, name, path, encodings=(), manifest=None):
     """Add a view used to render static assets.
 
     This calls ``config.add_static_view`` underneath the hood.
@@ -49,7 +60,21 @@ def add_cdn_view(config, name, path, encodings=()):
         http://cdn.example.com/path/mypackage/1.2.3
 
     Note that `path` is the path to the resource within the package.
+
+    If the resources were extracted with ``--fingerprint``, pass the
+    fingerprint manifest written by the extraction as ``manifest``. It can be
+    the URL or filesystem path of a copy of the manifest or ``True`` to fetch
+    it from the CDN. The version is then left out of the url and
+    ``request.static_url`` generates the fingerprinted URLs of the files:
+
+        http://cdn.example.com/path/mypackage/static/main-0123456789ab.css
+
+    Paths without a fingerprint, like directories, get the URL of the files
+    under their original name in the version:
+
+        http://cdn.example.com/path/mypackage/1.2.3/static/js
     """
+    from pyramid.asset import resolve_asset_spec
     package, filename = resolve_asset_spec(path, config.package_name)
     if package is None:
         raise ValueError("Package relative paths are required")
@@ -58,9 +83,16 @@ def add_cdn_view(config, name, path, encodings=()):
         # Name is an absolute url to CDN
         while name.endswith('/'):
             name = name[:-1]
-        dist = get_distribution(package)
+        dist = _get_distribution(package)
+        fingerprints = None
+        if manifest is not None:
+            if manifest is True:
+                manifest = '/'.join([name, dist.project_name, dist.version, _FINGERPRINTS_NAME])
+            fingerprints = _load_fingerprints(manifest)
         for enc in [None] + list(encodings):
-            parts = [name, dist.project_name, dist.version]
+            parts = [name, dist.project_name]
+            if fingerprints is None:
+                parts.append(dist.version)
             p = path
             if enc:
                 parts.append(enc)
@@ -69,15 +101,74 @@ def add_cdn_view(config, name, path, encodings=()):
             parts.append(filename)
             n = '/'.join(parts)
             config.add_static_view(name=n, path=p)
+            if fingerprints is not None:
+                # the view is outside the version, go back up to reach it
+                view_path = '/'.join(parts[2:])
+                version_path = '/'.join(['..'] * len(view_path.split('/')) +
+                                        [dist.version, view_path, ''])
+                config.add_cache_buster(p, _FingerprintCacheBuster(
+                    fingerprints, filename, version_path))
     else:
         if encodings:
             raise NotImplementedError('Refusing to guess what a static filesystem view with encodings mean (for now)')
+        if manifest is not None:
+            raise NotImplementedError('Fingerprinted URLs are only supported on a CDN')
         config.add_static_view(name=name, path=path)
 
 
+# seconds to wait for the CDN while the application is configured
+_URL_TIMEOUT = 10
+
+def _load_fingerprints(manifest, timeout=_URL_TIMEOUT):
+    if '://' not in manifest:
+        f = open(manifest, 'rb')
+        try:
+            return json.loads(f.read().decode('utf-8'))
+        finally:
+            f.close()
+    try:
+        from urllib.request import urlopen
+    except ImportError:
+        #python 2
+        from urllib2 import urlopen
+    logging.info("Loading fingerprints from %s", manifest)
+    try:
+        f = urlopen(manifest, timeout=timeout)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    except Exception:
+        e = sys.exc_info()[1]
+        raise IOError("Could not load the fingerprint manifest %s: %s" % (manifest, e))
+    return json.loads(data.decode('utf-8'))
+
+
+class _FingerprintCacheBuster:
+    """Pyramid cache buster which maps paths to their fingerprinted paths.
+
+    ``fingerprints`` maps resource paths within the package to the path of the
+    fingerprinted copy, ``resource_path`` is the path the static view serves.
+    Paths missing from ``fingerprints`` are prefixed with ``version_path``,
+    the relative path from the view to the files of the version.
+    """
+
+    def __init__(self, fingerprints, resource_path, version_path=''):
+        self._fingerprints = fingerprints
+        self._prefix = resource_path.rstrip('/') + '/'
+        self._version_path = version_path
+
+    def __call__(self, request, subpath, kw):
+        fingerprinted = self._fingerprints.get(self._prefix + subpath)
+        if fingerprinted is not None and fingerprinted.startswith(self._prefix):
+            return fingerprinted[len(self._prefix):], kw
+        return self._version_path + subpath, kw
+
+
 def extract_cmd(resources=None, target=None, yui_compressor=False,
                 ignore_stamps=False, encodings=None, args=sys.argv):
     """Export from the command line"""
+    import optparse
     parser = optparse.OptionParser(usage="usage: %prog [options]")
     res_help = "Resource to dump (may be repeated)."
     if resources is not None:
@@ -93,6 +184,30 @@ def extract_cmd(resources=None, target=None, yui_compressor=False,
     parser.add_option("--no-yui-compressor", dest="yui_compressor",
                       action="store_false",
                       help="Do not compress the files with yui-compressor")
+    parser.add_option("--rjsmin", dest="rjsmin", action="store_true",
+                      help=("Minify JS and CSS files in process with the "
+                            "python rjsmin and rcssmin packages instead of "
+                            "the yui-compressor"))
+    parser.add_option("--yui-modules", dest="yui_modules",
+                      action="store_true",
+                      help=("Write the YUI3 modules found in each directory "
+                            "of JS files to a .van.static-yui-modules.json "
+                            "next to them for van.static.yui.load_modules"))
+    parser.add_option("--yui-combo", dest="yui_combos", action="append",
+                      help=("Write the YUI3 modules needed by a list of "
+                            "modules of a group in one file for "
+                            "van.static.yui.combo_url (eg: "
+                            "mypackage:static/js=page,widget) (may be "
+                            "repeated, implies --yui-modules)"))
+    parser.add_option("--stage", dest="stages", action="append",
+                      help=("Process the files with a stage registered by "
+                            "another package in the van.static.stages entry "
+                            "point group (may be repeated)"))
+    parser.add_option("--yui-batch-size", dest="yui_batch_size", type="int",
+                      help=("Compress up to this many files with each "
+                            "yui-compressor process instead of starting one "
+                            "per file (needs a yui-compressor which supports "
+                            "multiple input files)"))
     parser.add_option("--cssutils-minify", dest="cssutils_minify",
                       action="store_true",
                       help=("Use the python cssutils package to minify the"
@@ -102,6 +217,19 @@ def extract_cmd(resources=None, target=None, yui_compressor=False,
                       action="store_true",
                       help=("Use the python cssutils package to resolve"
                             "@import statements in the CSS"))
+    parser.add_option("--processes", dest="processes", type="int",
+                      help=("Number of processes used to minify files at the "
+                            "same time (default: 1)"))
+    parser.add_option("--queue-size", dest="queue_size", type="int",
+                      help=("Read, process and put files in a thread per "
+                            "stage, with up to this many files queued "
+                            "between the stages"))
+    parser.add_option("--cache-dir", dest="cache_dir",
+                      help=("Directory in which to keep minified files between "
+                            "runs, unchanged files are not minified again"))
+    parser.add_option("--cache-size", dest="cache_size", type="int",
+                      help=("Maximum size of the --cache-dir in megabytes, the "
+                            "least recently used files are removed first"))
     parser.add_option("--target", dest="target",
                       help=("Where to put the resources (can be the name of a "
                             "local directory, or a url on S3 "
@@ -113,15 +241,53 @@ def extract_cmd(resources=None, target=None, yui_compressor=False,
                             "resources over HTTP. For each --encoding a "
                             "compressed copy of the file will be uploaded "
                             "to the target with the relevant 'Content-Encoding' "
-                            "header. The local-filesystem does not support this. "
-                            "The path of the encoded file upload is prefixed by "
-                            "the encoding."))
+                            "header. The path of the encoded file upload is "
+                            "prefixed by the encoding. On the local filesystem "
+                            "the compressed copy is placed next to the file "
+                            "instead (eg: example.css.gz) for servers which "
+                            "serve precompressed files. Supported encodings "
+                            "are gzip, br (needs brotli) and zstd (needs "
+                            "zstandard)."))
+    parser.add_option("--jobs", dest="jobs", type="int",
+                      help=("Number of files to upload to the target at the "
+                            "same time (default: 1)"))
+    parser.add_option("--manifest", dest="manifest",
+                      action="store_true",
+                      help=("Keep a manifest of content hashes in the target "
+                            "and only put files which were added or changed. "
+                            "Stamps are not checked when using a manifest."))
+    parser.add_option("--fingerprint", dest="fingerprint",
+                      action="store_true",
+                      help=("Put files under names containing a hash of their "
+                            "content outside the version prefix, and under "
+                            "their original names in the version, and write "
+                            "a manifest of the names for add_cdn_view. Files "
+                            "which did not change keep their URL across "
+                            "versions."))
     parser.add_option("--ignore-stamps", dest="ignore_stamps",
                       action="store_true",
                       help=("Stamp files are placed in the target to optimize "
                             "repeated uploads. If these files are found the "
                             "resource upload is skipped. Use this option to "
                             "ignore these files and always updload"))
+    parser.add_option("--blob-store", dest="blob_store",
+                      action="store_true",
+                      help=("Keep one copy of each distinct file in a .blobs "
+                            "directory of a local target and hard link the "
+                            "files of every version to it. Blobs no longer "
+                            "used have a link count of 1 (find -links 1)."))
+    parser.add_option("--copy-unchanged", dest="copy_unchanged",
+                      action="store_true",
+                      help=("Copy files which are already on S3, for example "
+                            "in an earlier version, inside S3 instead of "
+                            "uploading them again"))
+    parser.add_option("--multipart-threshold", dest="multipart_threshold",
+                      type="int",
+                      help=("Upload files larger than this many megabytes to "
+                            "S3 in parts of that size (at least 5MB)"))
+    parser.add_option("--s3-endpoint", dest="s3_endpoint",
+                      help=("URL of an S3 compatible server to use instead of "
+                            "Amazon S3 (eg: http://localhost:9000)"))
     parser.add_option("--aws-access-key", dest="aws_access_key",
                       help="AWS access key")
     parser.add_option("--aws-secret-key", dest="aws_secret_key",
@@ -148,10 +314,30 @@ def extract_cmd(resources=None, target=None, yui_compressor=False,
         raise AssertionError("Target is required")
     if not options.resources:
         raise AssertionError("Resources are required")
+    if options.cache_size is not None:
+        options.cache_size *= 1024 * 1024
+    if options.multipart_threshold is not None:
+        options.multipart_threshold *= 1024 * 1024
     kw = {}
     for opt in ['aws_access_key',
             'aws_secret_key',
+            's3_endpoint',
+            'multipart_threshold',
             'encodings',
+            'jobs',
+            'manifest',
+            'fingerprint',
+            'copy_unchanged',
+            'blob_store',
+            'yui_batch_size',
+            'rjsmin',
+            'yui_modules',
+            'yui_combos',
+            'stages',
+            'processes',
+            'queue_size',
+            'cache_dir',
+            'cache_size',
             'cssutils_minify',
             'cssutils_resolve_imports']:
         v = getattr(options, opt, None)
@@ -170,9 +356,25 @@ def _never_has_stamp(dist, path):
 def extract(resources, target, yui_compressor=True, ignore_stamps=False,
         cssutils_resolve_imports=False,
         cssutils_minify=False,
+        yui_batch_size=1,
+        rjsmin=False,
+        yui_modules=False,
+        yui_combos=(),
+        stages=(),
+        processes=1,
+        queue_size=None,
+        cache_dir=None,
+        cache_size=None,
         **kw):
     """Export the resources"""
     putter = _get_putter(target, **kw)
+    cache = None
+    if cache_dir is not None:
+        cache = _Cache(cache_dir, cache_size)
+    pool = None
+    if processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
     try:
         stamps = mkdtemp()
         try:
@@ -181,35 +383,118 @@ def extract(resources, target, yui_compressor=True, ignore_stamps=False,
                 has_stamp = putter.has_stamp
             r_files = _walk_resources(resources, has_stamp, stamps)
             pipeline = []
+            threads = []
             try:
                 # construct pipeline from config
-                # in the right order
+                enabled = []
                 if cssutils_resolve_imports or cssutils_minify:
-                    pipeline.append(_CSSUtils(
+                    enabled.append(('cssutils', dict(
                         resolve_imports=cssutils_resolve_imports,
-                        minify=cssutils_minify))
-                if yui_compressor:
-                    pipeline.append(_YUICompressor())
+                        minify=cssutils_minify)))
+                if rjsmin:
+                    enabled.append(('rjsmin', {}))
+                elif yui_compressor:
+                    enabled.append(('yui-compressor',
+                                    dict(batch_size=yui_batch_size)))
+                if yui_modules or yui_combos:
+                    enabled.append(('yui-modules', {}))
+                if yui_combos:
+                    enabled.append(('yui-combos', dict(combos=yui_combos)))
+                for name in stages:
+                    enabled.append((name, {}))
+                registry = _stages([name for name, stage_kw in enabled])
+                for name, stage_kw in enabled:
+                    pipeline.append(registry[name](**stage_kw))
+                # in the right order
+                pipeline.sort(key=lambda p: getattr(p, 'order', _Stage.order))
                 # build iterator out of pipelines
+                if queue_size is not None:
+                    r_files = _ThreadedIterator(r_files, queue_size)
+                    threads.append(r_files)
                 for p in pipeline:
-                    r_files = p.process(r_files)
+                    if isinstance(p, _Stage) and p.cacheable:
+                        p.cache = cache
+                    if pool is not None and isinstance(p, _Stage) and p.parallel:
+                        r_files = _parallel_process(p, r_files, pool, processes * 2)
+                    else:
+                        r_files = p.process(r_files)
+                    if queue_size is not None:
+                        r_files = _ThreadedIterator(r_files, queue_size)
+                        threads.append(r_files)
                 # execute pipeline
                 putter.put(r_files)
             finally:
+                # stop all threads before their stages are disposed
+                for t in threads:
+                    t.stop()
+                for t in threads:
+                    t.close()
                 # dispose all bits of the pipeline to clean temporary files
                 for p in pipeline:
                     p.dispose()
         finally:
             shutil.rmtree(stamps)
     finally:
+        if pool is not None:
+            pool.terminate()
+        if cache is not None:
+            cache.close()
         putter.close()
 
 
+def _stages(names):
+    """Return the pipeline stage factories of ``names`` by name.
+
+    Other packages register stages with entry points in the
+    ``van.static.stages`` group. The entry point is called without arguments
+    and returns a ``Stage``, or any object with ``process(files)`` and
+    ``dispose()`` methods. Only the entry points of ``names`` are loaded and
+    they can not replace the built-in stages.
+    """
+    builtin = {
+        'cssutils': _CSSUtils,
+        'rjsmin': _RJSMin,
+        'yui-compressor': _YUICompressor,
+        'yui-modules': _YUIModules,
+        'yui-combos': _YUICombos}
+    stages = {}
+    for name in names:
+        if name in builtin:
+            stages[name] = builtin[name]
+    wanted = set(names) - set(stages)
+    if wanted:
+        for ep in _compat.entry_points('van.static.stages'):
+            if ep.name in builtin:
+                logging.warning("Ignoring the entry point of the built-in stage %s: %s",
+                                ep.name, ep)
+            elif ep.name in wanted and ep.name not in stages:
+                stages[ep.name] = ep.load()
+    for name in names:
+        if name not in stages:
+            raise NotImplementedError(name)
+    return stages
+
+
+# options which only mean something for one kind of target
+_TARGET_OPTIONS = {
+        'file': ('blob_store',),
+        's3': ('aws_access_key', 'aws_secret_key', 's3_endpoint',
+               'multipart_threshold', 'jobs', 'copy_unchanged')}
+
 def _get_putter(target, **kw):
     schema = target.split(':')[0]
     putter = {
             'file': _PutLocal,
             's3': _PutS3}[schema]
+    # refuse instead of silently ignoring, before anything is put
+    for other, names in sorted(_TARGET_OPTIONS.items()):
+        if other == schema:
+            continue
+        for name in names:
+            if kw.get(name) not in (None, False):
+                raise ValueError("--%s is only supported for %s:// targets" % (
+                    name.replace('_', '-'), other))
+            kw.pop(name, None)
     return putter(target, **kw)
 
 
@@ -239,13 +524,57 @@ def config_static(config, static_resources, static_cdn=None):
             add_cdn_view(config, name=static_cdn, path=path)
 
 
+class _Distribution:
+    """The project name and version of an installed distribution."""
+
+    def __init__(self, project_name, version):
+        self.project_name = project_name
+        self.version = version
+
+    def __eq__(self, other):
+        return (isinstance(other, _Distribution)
+                and (self.project_name, self.version) == (other.project_name, other.version))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.project_name, self.version))
+
+    def __repr__(self):
+        return '%s %s' % (self.project_name, self.version)
+
+
+_DISTRIBUTIONS = {}
+
+def _get_distribution(name):
+    dist = _DISTRIBUTIONS.get(name)
+    if dist is None:
+        try:
+            from importlib.metadata import distribution
+        except ImportError:
+            # python < 3.8
+            from pkg_resources import get_distribution
+            d = get_distribution(name)
+            dist = _Distribution(d.project_name, d.version)
+        else:
+            d = distribution(name)
+            # the project name as pkg_resources.safe_name gives it, it is
+            # part of the paths in the targets
+            project_name = re.sub('[^A-Za-z0-9.]+', '-', d.metadata['Name'])
+            dist = _Distribution(project_name, d.version)
+        _DISTRIBUTIONS[name] = dist
+    return dist
+
+
 def _walk_resource_directory(pname, resource_directory):
     """Walk a resource directory and yield all files.
 
     Files are yielded as the path to the resource.
     """
+    from pkg_resources import resource_listdir, resource_isdir
     yield resource_directory, 'dir'
-    for member in resource_listdir(pname, resource_directory):
+    for member in sorted(resource_listdir(pname, resource_directory)):
         if member.startswith('.'):
             continue
         r_path = '/'.join([resource_directory, member])
@@ -260,18 +589,132 @@ def _walk_resource_directory(pname, resource_directory):
             yield r_path, 'file'
 
 
+def _scan_directory(directory, resource_directory):
+    """Walk a resource directory on the filesystem and yield all files.
+
+    Like ``_walk_resource_directory`` but for unpacked distributions. Files
+    are yielded as ``(resource path, filesystem path, type, extra)`` where
+    extra holds the size and mtime of files for the record.
+    """
+    yield resource_directory, directory, 'dir', {}
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        if entry.name.startswith('.'):
+            continue
+        r_path = '/'.join([resource_directory, entry.name])
+        if entry.is_dir():
+            logging.debug("_scan_directory: Recursing into directory %s", entry.path)
+            for r in _scan_directory(entry.path, r_path):
+                yield r
+        else:
+            st = entry.stat()
+            yield r_path, entry.path, 'file', dict(size=st.st_size, mtime=st.st_mtime)
+
+
+def _walk_zip(archive, prefix, resource_directory):
+    """Walk a resource directory inside a zip archive without extracting it.
+
+    ``prefix`` is the path of the package in the archive. Yields the same
+    tuples as ``_scan_directory``, files are read from the archive as
+    streams so the filesystem path is None.
+    """
+    base = prefix + resource_directory + '/'
+    tree = {}
+    for info in _zip_file(archive).infolist():
+        if not info.filename.startswith(base) or info.filename.endswith('/'):
+            continue
+        parts = info.filename[len(base):].split('/')
+        node = tree
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = info
+    def walk(node, r_dir):
+        yield r_dir, None, 'dir', {}
+        for name in sorted(node):
+            if name.startswith('.'):
+                continue
+            r_path = '/'.join([r_dir, name])
+            info = node[name]
+            if isinstance(info, dict):
+                for r in walk(info, r_path):
+                    yield r
+            else:
+                yield r_path, None, 'file', dict(
+                        size=info.file_size,
+                        mtime=time.mktime(info.date_time + (0, 0, -1)),
+                        stream=_ZipMember(archive, info.filename))
+    return walk(tree, resource_directory)
+
+
+_ZIP_FILES = {}
+
+def _zip_file(archive):
+    # parsing the directory of a large archive is slow, keep them open
+    zf = _ZIP_FILES.get(archive)
+    if zf is None:
+        import zipfile
+        zf = _ZIP_FILES[archive] = zipfile.ZipFile(archive)
+    return zf
+
+
+class _ZipMember:
+    """A file inside a zip archive, opened as a stream."""
+
+    def __init__(self, archive, name):
+        self.archive = archive
+        self.name = name
+
+    def __eq__(self, other):
+        return (isinstance(other, _ZipMember)
+                and (self.archive, self.name) == (other.archive, other.name))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<_ZipMember %s in %s>' % (self.name, self.archive)
+
+    def open(self):
+        return _zip_file(self.archive).open(self.name)
+
+
+def _walk_files(pname, resource_directory):
+    """Yield ``(resource path, filesystem path, type, extra)`` of a resource.
+
+    Unpacked distributions are scanned directly and zipped ones read from
+    the archive. Resources of other distributions go through the
+    pkg_resources provider for each entry.
+    """
+    root = _compat.files(pname)
+    if root is not None:
+        import pathlib
+        import zipfile
+        if isinstance(root, pathlib.Path) and getattr(os, 'scandir', None) is not None:
+            directory = os.path.join(str(root), *resource_directory.split('/'))
+            return _scan_directory(directory, resource_directory)
+        if isinstance(root, zipfile.Path):
+            return _walk_zip(root.root.filename, root.at, resource_directory)
+    from pkg_resources import get_provider, DefaultProvider, ZipProvider, resource_filename
+    provider = get_provider(pname)
+    if getattr(os, 'scandir', None) is not None and isinstance(provider, DefaultProvider):
+        return _scan_directory(resource_filename(pname, resource_directory), resource_directory)
+    if isinstance(provider, ZipProvider):
+        archive = provider.loader.archive
+        prefix = os.path.relpath(provider.module_path, archive).replace(os.sep, '/')
+        return _walk_zip(archive, prefix + '/', resource_directory)
+    return ((r, resource_filename(pname, r), type, {})
+            for r, type in _walk_resource_directory(pname, resource_directory))
+
+
 def _walk_resources(resources, has_stamp, tmpdir):
     for res in resources:
         pname, r_path = res.split(':', 1)
-        dist = get_distribution(pname)
+        dist = _get_distribution(pname)
         if has_stamp(dist, r_path):
             logging.info("Stamp found, skipping %s:%s", pname, r_path)
             continue
         logging.info("Walking %s:%s", pname, r_path)
-        resources = _walk_resource_directory(pname, r_path)
-        for r, type in resources:
-            fs_r = resource_filename(pname, r)
-            yield _to_dict(r, fs_r, pname, dist, type)
+        for r, fs_r, type, extra in _walk_files(pname, r_path):
+            yield _to_dict(r, fs_r, pname, dist, type, **extra)
         handle, fs_r = mkstemp(dir=tmpdir)
         f = os.fdopen(handle, 'w')
         try:
@@ -280,26 +723,195 @@ def _walk_resources(resources, has_stamp, tmpdir):
             f.close()
         yield _to_dict(r_path, fs_r, pname, dist, 'stamp')
 
-def _stamp_resource(dist, resource_path, encodings=None):
-    _stamp_dist = get_distribution('van.static')
+def _stamp_resource(dist, resource_path, encodings=None, fingerprint=False):
+    _stamp_dist = _get_distribution('van.static')
     r_path = resource_path
     if _PY3:
         r_path32 = base64.b32encode(r_path.encode('utf-8')).decode('ascii')
     else:
         r_path32 = base64.b32encode(r_path)
-    if not encodings:
+    flavours = sorted(encodings or ())
+    if fingerprint:
+        flavours.append('fingerprint')
+    if not flavours:
         return _stamp_dist, '%s-%s-%s.stamp' % (dist.project_name, dist.version, r_path32)
-    encodings = '-'.join(sorted(encodings))
-    return _stamp_dist, '%s-%s-%s-%s.stamp' % (dist.project_name, dist.version, encodings, r_path32)
+    flavours = '-'.join(flavours)
+    return _stamp_dist, '%s-%s-%s-%s.stamp' % (dist.project_name, dist.version, flavours, r_path32)
+
+_MANIFEST_NAME = '.van.static-manifest.json'
+_BLOBS_NAME = '.blobs'
+_FINGERPRINTS_NAME = '.van.static-fingerprints.json'
+
+class _Manifest:
+    """Content hashes of the files put in a target.
+
+    A manifest is kept in every version prefix of the target as a JSON
+    mapping of the path within that prefix to the MD5 of the file. Putters
+    use it to only send files which were added or changed.
+
+    ``read(dist, path)`` and ``write(dist, path, data)`` are the putter's
+    functions to access the target. With ``name`` other mappings, like the
+    fingerprinted paths of the files, are kept the same way.
+    """
+
+    def __init__(self, read, write, name=_MANIFEST_NAME):
+        self._read = read
+        self._write = write
+        self._name = name
+        self._manifests = {}
+        self._dirty = {}
+
+    def get(self, dist):
+        k = (dist.project_name, dist.version)
+        manifest = self._manifests.get(k)
+        if manifest is None:
+            data = self._read(dist, self._name)
+            manifest = {}
+            if data:
+                manifest = json.loads(data.decode('utf-8'))
+            self._manifests[k] = manifest
+        return manifest
+
+    def unchanged(self, dist, path, digest):
+        return self.get(dist).get(path) == digest
+
+    def update(self, dist, path, digest):
+        self.get(dist)[path] = digest
+        self._dirty[(dist.project_name, dist.version)] = dist
+
+    def save(self):
+        for k, dist in sorted(self._dirty.items()):
+            logging.info("Writing %s for %s %s", self._name, *k)
+            data = json.dumps(self._manifests[k], indent=0, sort_keys=True)
+            self._write(dist, self._name, data.encode('utf-8'))
+        self._dirty = {}
+
+
+def _file_digest(f):
+    import hashlib
+    h = hashlib.md5()
+    fp = _open_file(f)
+    try:
+        for chunk in iter(lambda: fp.read(_CHUNK_SIZE), b''):
+            h.update(chunk)
+    finally:
+        fp.close()
+    return h.hexdigest()
+
+
+def _fingerprint_path(path, digest):
+    """Insert the start of the content digest before the file extension.
+
+    e.g. ``static/css/main.css`` becomes ``static/css/main-0123456789ab.css``
+    """
+    head, tail = path.rsplit('/', 1) if '/' in path else ('', path)
+    base, ext = os.path.splitext(tail)
+    tail = '%s-%s%s' % (base, digest[:12], ext)
+    if head:
+        return '/'.join([head, tail])
+    return tail
+
+# references of CSS to other files, url(...) and @import "..."
+_CSS_REFERENCE = re.compile(r'''(url\(\s*['"]?|@import\s+['"])([^'"()\s]+)''')
+
+class _Content:
+    """Content held in memory, opened as a stream like a ``_ZipMember``."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def open(self):
+        from io import BytesIO
+        return BytesIO(self.data)
+
+def _read_css(f):
+    source = _open_file(f)
+    try:
+        # latin-1 decodes any byte, the CSS is written back unchanged
+        return source.read().decode('latin-1')
+    finally:
+        source.close()
+
+def _css_reference(directory, ref):
+    """Return the resource path a reference in a CSS file in ``directory``
+    points to, None for URLs, absolute paths and data."""
+    path = re.split('[?#]', ref, 1)[0]
+    if not path or path.startswith('/') or ':' in path.split('/', 1)[0]:
+        return None
+    resolved = posixpath.normpath(posixpath.join(directory, path))
+    if resolved == '..' or resolved.startswith('../'):
+        return None
+    return resolved
+
+def _css_order(records):
+    """Return the CSS records, the ones referenced by others first."""
+    by_path = dict(((f['distribution_name'], f['resource_path']), f) for f in records)
+    ordered = []
+    seen = set()
+    def visit(f):
+        k = (f['distribution_name'], f['resource_path'])
+        if k in seen:
+            return
+        seen.add(k)
+        directory = f['resource_path'].rpartition('/')[0]
+        for match in _CSS_REFERENCE.finditer(_read_css(f)):
+            path = _css_reference(directory, match.group(2))
+            referenced = by_path.get((f['distribution_name'], path))
+            if referenced is not None:
+                visit(referenced)
+        ordered.append(f)
+    for f in records:
+        visit(f)
+    return ordered
+
+def _fingerprint_references(f, fingerprints):
+    """Return the CSS record ``f`` referencing the fingerprinted names.
+
+    ``fingerprints`` maps resource paths to their fingerprinted paths. If a
+    relative reference of ``f`` changed, the returned record holds the new
+    CSS in memory, otherwise ``f`` itself is returned.
+    """
+    directory = f['resource_path'].rpartition('/')[0]
+    def replace(match):
+        ref = match.group(2)
+        fingerprinted = fingerprints.get(_css_reference(directory, ref))
+        if fingerprinted is None:
+            return match.group(0)
+        # only the file name changes, the query and fragment are kept
+        path = re.split('[?#]', ref, 1)[0]
+        head = path[:len(path) - len(path.split('/')[-1])]
+        return match.group(1) + head + fingerprinted.split('/')[-1] + ref[len(path):]
+    css = _read_css(f)
+    rewritten = _CSS_REFERENCE.sub(replace, css)
+    if rewritten == css:
+        return f
+    data = rewritten.encode('latin-1')
+    return _to_dict(f['resource_path'], None, f['distribution_name'],
+                    f['distribution'], 'file', size=len(data), stream=_Content(data))
+
 
 class _PutLocal:
 
     _hard_link = True
 
-    def __init__(self, target):
+    def __init__(self, target, manifest=False, encodings=(), fingerprint=False,
+                 blob_store=False):
         assert target.startswith('file:///')
+        for enc in encodings:
+            if enc not in _ENCODING_SUFFIXES:
+                raise NotImplementedError(enc)
+        self._encodings = encodings
         self._target_dir = target = target[7:]
         logging.info("Putting resources in %s", self._target_dir)
+        self._manifest = None
+        if manifest:
+            self._manifest = _Manifest(self._read, self._write)
+        self._fingerprints = None
+        if fingerprint:
+            self._fingerprints = _Manifest(self._read, self._write, _FINGERPRINTS_NAME)
+        self._blobs = None
+        if blob_store:
+            self._blobs = os.path.join(self._target_dir, _BLOBS_NAME)
 
     def close(self):
         pass
@@ -315,37 +927,197 @@ class _PutLocal:
                 raise
 
     def has_stamp(self, dist, resource_path):
-        stamp_dist, stamp_path = _stamp_resource(dist, resource_path)
+        if self._manifest is not None:
+            # the manifest is checked file by file instead
+            return False
+        stamp_dist, stamp_path = _stamp_resource(dist, resource_path, encodings=self._encodings,
+                                                 fingerprint=self._fingerprints is not None)
         return self.exists(stamp_dist, stamp_path)
 
     def exists(self, dist, path):
-        target = os.path.join(self._target_dir, dist.project_name,
-                              dist.version, path)
-        return os.path.exists(target)
+        return os.path.exists(self._path(dist, path))
+
+    def _path(self, dist, path):
+        fs_path = path.replace('/', os.sep)  # enough for windows?
+        return os.path.join(self._target_dir, dist.project_name,
+                            dist.version, fs_path)
+
+    def _project_path(self, dist, path):
+        # outside the version prefix
+        fs_path = path.replace('/', os.sep)
+        return os.path.join(self._target_dir, dist.project_name, fs_path)
+
+    def _read(self, dist, path):
+        target = self._path(dist, path)
+        if not os.path.exists(target):
+            return None
+        f = open(target, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _write(self, dist, path, data):
+        target = self._path(dist, path)
+        self._if_not_exist(os.makedirs, os.path.dirname(target))
+        f = open(target, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
 
     def put(self, files):
         proj_dirs = set([])
+        css = []
         for f in files:
             rpath = f['resource_path']
             fs_rpath = f['filesystem_path']
-            pname = f['distribution_name']
             dist = f['distribution']
             type = f['type']
             if type == 'stamp':
-                dist, rpath = _stamp_resource(dist, rpath)
-                type = 'file'
-            fs_path = rpath.replace('/', os.sep)  # enough for windows?
-            target = os.path.join(self._target_dir, dist.project_name,
-                                  dist.version, fs_path)
-            if pname not in proj_dirs:
+                if self._fingerprints is not None:
+                    self._put_css(css)
+                    css = []
+                    # the fingerprints must be found for a stamped resource
+                    self._fingerprints.save()
+                dist, rpath = _stamp_resource(dist, rpath, encodings=self._encodings,
+                                              fingerprint=self._fingerprints is not None)
+            if (dist.project_name, dist.version) not in proj_dirs:
                 self._if_not_exist(os.makedirs, os.path.join(self._target_dir,
                                                              dist.project_name,
                                                              dist.version))
-                proj_dirs.add(pname)
-            if type == 'file':
-                self._copy(fs_rpath, target)
+                proj_dirs.add((dist.project_name, dist.version))
+            if type == 'stamp':
+                self._copy(fs_rpath, self._path(dist, rpath))
+            elif type == 'file' and self._fingerprints is not None and rpath.endswith('.css'):
+                # put once the files it references have their fingerprints
+                css.append(f)
+            elif type == 'file' and self._fingerprints is not None:
+                self._put_fingerprinted(f)
+            elif type == 'file':
+                self._put_file(f)
             else:
-                self._if_not_exist(os.makedirs, target)
+                self._if_not_exist(os.makedirs, self._path(dist, rpath))
+        if self._manifest is not None:
+            self._manifest.save()
+        if self._fingerprints is not None:
+            self._put_css(css)
+            self._fingerprints.save()
+
+    def _put_file(self, f):
+        rpath = f['resource_path']
+        dist = f['distribution']
+        # precompressed siblings for servers like nginx's gzip_static
+        variants = [(None, rpath)]
+        if self._encodings and _guess_type(rpath) in _GZ_MIMETYPES:
+            for enc in self._encodings:
+                variants.append((enc, rpath + _ENCODING_SUFFIXES[enc]))
+        digest = None
+        if self._manifest is not None or self._blobs is not None:
+            digest = _file_digest(f)
+        for enc, path in variants:
+            if self._manifest is not None and self._manifest.unchanged(dist, path, digest) and self.exists(dist, path):
+                logging.debug("Unchanged, skipping %s:%s", f['distribution_name'], path)
+                continue
+            self._put_variant(enc, f, self._path(dist, path), digest)
+            if self._manifest is not None:
+                self._manifest.update(dist, path, digest)
+
+    def _put_css(self, records):
+        for f in _css_order(records):
+            fingerprints = self._fingerprints.get(f['distribution'])
+            self._put_fingerprinted(f, _fingerprint_references(f, fingerprints))
+
+    def _put_fingerprinted(self, f, content=None):
+        """Put ``f`` under its fingerprinted name and in the version.
+
+        ``content`` is the record put under the fingerprinted name if it
+        differs from ``f``, like CSS referencing fingerprinted names.
+        """
+        if content is None:
+            content = f
+        rpath = f['resource_path']
+        dist = f['distribution']
+        digest = _file_digest(content)
+        path = _fingerprint_path(rpath, digest)
+        unchanged = self._fingerprints.unchanged(dist, rpath, path)
+        # fingerprinted files are shared by all versions of the project
+        target = self._project_path(dist, path)
+        self._if_not_exist(os.makedirs, os.path.dirname(target))
+        suffixes = [(None, '')]
+        if self._encodings and _guess_type(rpath) in _GZ_MIMETYPES:
+            for enc in self._encodings:
+                suffixes.append((enc, _ENCODING_SUFFIXES[enc]))
+        for enc, suffix in suffixes:
+            if os.path.exists(target + suffix):
+                # the name changes with the content, it is already there
+                logging.debug("Fingerprint exists, skipping %s", target + suffix)
+                continue
+            self._put_variant(enc, content, target + suffix, digest)
+        self._fingerprints.update(dist, rpath, path)
+        # relative references, like the modules of a YUI group, find the
+        # files under their original name in the version
+        original = self._path(dist, rpath)
+        self._if_not_exist(os.makedirs, os.path.dirname(original))
+        original_digest = digest
+        if content is not f:
+            original_digest = _file_digest(f)
+        for enc, suffix in suffixes:
+            if unchanged and os.path.exists(original + suffix):
+                logging.debug("Unchanged, skipping %s", original + suffix)
+            elif content is f:
+                self._copy(target + suffix, original + suffix)
+            else:
+                self._put_variant(enc, f, original + suffix, original_digest)
+
+    def _put_variant(self, enc, f, target, digest):
+        if self._blobs is not None:
+            self._put_blob(enc, f, target, digest)
+        else:
+            self._put_content(enc, f, target)
+
+    def _put_content(self, enc, f, target):
+        if enc is not None:
+            self._encode(enc, f, target)
+        elif f['filesystem_path'] is None:
+            _write_file(f, target)
+        else:
+            self._copy(f['filesystem_path'], target)
+
+    def _put_blob(self, enc, f, target, digest):
+        """Link target to the blob of the content, adding the blob if needed.
+
+        Blobs are named by the digest of the source, encoded copies by the
+        digest and the encoding's suffix, so identical files of all versions
+        and projects share a single copy on disk.
+        """
+        blob = os.path.join(self._blobs, digest[:2], digest)
+        if enc is not None:
+            blob += _ENCODING_SUFFIXES[enc]
+        if not os.path.exists(blob):
+            self._if_not_exist(os.makedirs, os.path.dirname(blob))
+            # write under a temporary name so a blob is always complete
+            tmp = '%s.%s.tmp' % (blob, os.getpid())
+            self._put_content(enc, f, tmp)
+            os.rename(tmp, blob)
+        else:
+            logging.debug("Blob exists for %s", target)
+        self._copy(blob, target)
+
+    def _encode(self, enc, f, target):
+        logging.debug("Encoding %s with %s to %s", f['resource_path'], enc, target)
+        if os.path.exists(target):
+            # never write through a hard link to another file
+            os.remove(target)
+        source = _open_file(f)
+        try:
+            dest = open(target, 'wb')
+            try:
+                _ENCODERS[enc](f['resource_path'].split('/')[-1], source, dest)
+            finally:
+                dest.close()
+        finally:
+            source.close()
 
     def _copy(self, source, target):
         if self._hard_link:
@@ -365,8 +1137,15 @@ class _PutLocal:
                 self._copy(source, target)
         else:
             logging.debug("Copying %s to %s", source, target)
+            if os.path.exists(target):
+                # never write through a hard link to another file
+                os.remove(target)
             shutil.copy(source, target)
 
+def _guess_type(path):
+    import mimetypes
+    return mimetypes.guess_type(path)[0]
+
 _GZ_MIMETYPES = frozenset([
         'text/plain',
         'text/html',
@@ -380,40 +1159,102 @@ _GZ_MIMETYPES = frozenset([
 
 class _PutS3:
 
-    _cached_bucket = None
-
-    def __init__(self, target, aws_access_key=None, aws_secret_key=None, encodings=()):
+    def __init__(self, target, aws_access_key=None, aws_secret_key=None, encodings=(), jobs=1,
+                 manifest=False, multipart_threshold=None, s3_endpoint=None, fingerprint=False,
+                 copy_unchanged=False):
         # parse URL by hand as urlparse in python2.5 doesn't
         assert target.startswith('s3://')
         target = target[5:]
         bucket, path = target.split('/', 1)
         self._encodings = encodings
+        self._jobs = jobs
         self._bucket_name = bucket
         self._path = '/%s' % path
         self._aws_access_key = aws_access_key
         self._aws_secret_key = aws_secret_key
-        self._tmpdir = mkdtemp()
-
-    def _get_temp_file(self):
-        handle, filename = mkstemp(dir=self._tmpdir)
-        return os.fdopen(handle, 'wb'), filename
+        self._multipart_threshold = multipart_threshold
+        self._s3_endpoint = s3_endpoint
+        # boto connections are not thread safe, each thread gets it's own
+        self._local = threading.local()
+        # key names under the prefixes listed so far
+        self._index = {}
+        # (encoding, digest) of files already in S3 to key names by project
+        self._copy_unchanged = copy_unchanged
+        self._sources = {}
+        self._manifest = None
+        if manifest:
+            self._manifest = _Manifest(self._read, self._write)
+        self._fingerprints = None
+        if fingerprint:
+            self._fingerprints = _Manifest(self._read, self._write, _FINGERPRINTS_NAME)
 
     @property
     def _bucket(self):
-        if self._cached_bucket is None:
+        bucket = getattr(self._local, 'bucket', None)
+        if bucket is None:
             S3Connection = self._get_conn_class()
-            conn = S3Connection(self._aws_access_key, self._aws_secret_key)
-            self._cached_bucket = conn.get_bucket(self._bucket_name, validate=False)
-        return self._cached_bucket
+            kw = {}
+            if self._s3_endpoint is not None:
+                kw = self._endpoint_kw(self._s3_endpoint)
+            conn = S3Connection(self._aws_access_key, self._aws_secret_key, **kw)
+            bucket = self._local.bucket = conn.get_bucket(self._bucket_name, validate=False)
+        return bucket
 
     def has_stamp(self, dist, resource_path):
-        stamp_dist, stamp_path = _stamp_resource(dist, resource_path, encodings=self._encodings)
+        if self._manifest is not None:
+            # the manifest is checked file by file instead
+            return False
+        stamp_dist, stamp_path = _stamp_resource(dist, resource_path, encodings=self._encodings,
+                                                 fingerprint=self._fingerprints is not None)
         return self.exists(stamp_dist, stamp_path)
 
     def exists(self, dist, path):
-        target = '/'.join([self._path, dist.project_name, dist.version,
-                           path])
-        return self._bucket.get_key(target) is not None
+        prefix = '/'.join([self._path, dist.project_name, dist.version, ''])
+        return prefix + path in self._list(prefix)
+
+    def _fingerprint_exists(self, target):
+        # one listing per directory, fingerprinted files of all versions
+        # of a project are kept outside the version prefixes
+        prefix = target.rsplit('/', 1)[0] + '/'
+        return target in self._list(prefix)
+
+    def _list(self, prefix):
+        """Return the names of all keys under prefix.
+
+        Each prefix is only listed once, a single LIST request answers all
+        existence checks for a version instead of one request per key.
+        """
+        keys = self._index.get(prefix)
+        if keys is None:
+            logging.debug("S3: listing keys under %s", prefix)
+            # boto pages through the results for us
+            keys = set([k.name for k in self._bucket.list(prefix=prefix)])
+            self._index[prefix] = keys
+        return keys
+
+    def _indexed(self, target):
+        # record a key we put for prefixes which were listed already
+        for prefix, keys in list(self._index.items()):
+            if target.startswith(prefix):
+                keys.add(target)
+
+    def _read(self, dist, path):
+        # a single GET, listing the version to find one key costs more
+        target = '/'.join([self._path, dist.project_name, dist.version, path])
+        key = self._bucket.get_key(target)
+        if key is None:
+            return None
+        return key.get_contents_as_string()
+
+    def _write(self, dist, path, data):
+        key = self._get_key_class()(self._bucket)
+        key.key = '/'.join([self._path, dist.project_name, dist.version, path])
+        key.set_contents_from_string(
+                data,
+                reduced_redundancy=True,
+                headers={'Content-Type': 'application/json'},
+                policy='public-read')
+        self._indexed(key.key)
 
     def _get_conn_class(self):
         # lazy import to not have a hard dependency on boto
@@ -425,89 +1266,584 @@ class _PutS3:
         from boto.s3.key import Key
         return Key
 
-    def _should_gzip(self, mimetype):
+    def _get_multipart_class(self):
+        from boto.s3.multipart import MultiPartUpload
+        return MultiPartUpload
+
+    def _endpoint_kw(self, endpoint):
+        # talk to an S3 compatible server, e.g. a local stand-in for tests
+        from boto.s3.connection import OrdinaryCallingFormat
+        url = urlparse(endpoint)
+        kw = dict(host=url.hostname,
+                  is_secure=url.scheme == 'https',
+                  calling_format=OrdinaryCallingFormat())
+        if url.port:
+            kw['port'] = url.port
+        return kw
+
+    def _should_encode(self, mimetype):
         return mimetype in _GZ_MIMETYPES
 
     def close(self):
-        if self._tmpdir is not None:
-            logging.debug("_S3Putter: removing temp workspace: %s",
-                          self._tmpdir)
-            shutil.rmtree(self._tmpdir)
-            self._tmpdir = None
+        pass
 
     def put(self, files):
         logging.info("S3: putting resources to bucket %s with encodings: %s", self._bucket_name, self._encodings)
-        Key = self._get_key_class()
-        bucket = self._bucket
         encodings = [None] + list(self._encodings)
+        uploads = []
+        originals = []
+        css = []
         for f in files:
             if f['type'] == 'dir':
                 continue
             elif f['type'] == 'stamp':
-                dist, rpath = _stamp_resource(f['distribution'], f['resource_path'], encodings=self._encodings)
+                self._fingerprint_css(css, encodings, uploads, originals)
+                css = []
+                # every file of the resource must be uploaded before stamping
+                self._upload_all(uploads, originals)
+                uploads = []
+                originals = []
+                if self._fingerprints is not None:
+                    self._fingerprints.save()
+                dist, rpath = _stamp_resource(f['distribution'], f['resource_path'], encodings=self._encodings,
+                                              fingerprint=self._fingerprints is not None)
                 target = '/'.join([self._path, dist.project_name, dist.version, rpath])
                 logging.info("Stamping resource %s:%s in S3: %s", f['distribution_name'], f['resource_path'], target)
-                key = Key(bucket)
+                key = self._get_key_class()(self._bucket)
                 key.key = target
                 key.set_contents_from_filename(
                         f['filesystem_path'],
                         reduced_redundancy=True,
                         policy='public-read')
+                self._indexed(target)
                 continue
-            dist = f['distribution']
-            prefix = '/'.join([self._path, dist.project_name, dist.version])
-            filename = f['resource_path'].split('/')[-1]
-            mimetype = mimetypes.guess_type(filename)[0]
+            if self._fingerprints is not None and f['resource_path'].endswith('.css'):
+                # put once the files it references have their fingerprints
+                css.append(f)
+                continue
+            elif self._fingerprints is not None:
+                f_uploads, f_originals = self._fingerprinted_uploads(f, encodings)
+                uploads.extend(f_uploads)
+                originals.extend(f_originals)
+                continue
+            digest = None
+            if self._manifest is not None or self._copy_unchanged:
+                digest = _file_digest(f)
             for enc in encodings:
-                headers = {'Cache-Control': 'max-age=32140800'}
-                if mimetype:
-                    headers['Content-Type'] = mimetype
-                if enc is None:
-                    target = '/'.join([prefix, f['resource_path']])
-                    fs_path = f['filesystem_path']
-                elif enc == 'gzip':
-                    target = '/'.join([prefix, enc, f['resource_path']])
-                    if self._should_gzip(mimetype):
-                        headers['Content-Encoding'] = 'gzip'
-                        source = f['filesystem_path']
-                        c_file, fs_path = self._get_temp_file()
-                        try:
-                            file = gzip.GzipFile(filename, 'wb', 9, c_file)
-                            try:
-                                source = open(source, 'rb')
-                                try:
-                                    file.write(source.read())
-                                finally:
-                                    source.close()
-                            finally:
-                                file.close()
-                        finally:
-                            c_file.close()
-                    else:
-                        fs_path = f['filesystem_path']
-                else:
-                    raise NotImplementedError()
-                logging.info("putting to S3: %s with headers: %s", target, headers)
-                key = Key(bucket)
-                key.key = target
+                path = _encoded_path(enc, f['resource_path'])
+                if self._manifest is not None and self._manifest.unchanged(f['distribution'], path, digest):
+                    logging.debug("Unchanged, skipping %s:%s", f['distribution_name'], path)
+                    continue
+                uploads.append((f, enc, digest))
+        self._fingerprint_css(css, encodings, uploads, originals)
+        self._upload_all(uploads, originals)
+        if self._fingerprints is not None:
+            self._fingerprints.save()
+
+    def _fingerprint_css(self, records, encodings, uploads, originals):
+        for f in _css_order(records):
+            fingerprints = self._fingerprints.get(f['distribution'])
+            content = _fingerprint_references(f, fingerprints)
+            f_uploads, f_originals = self._fingerprinted_uploads(f, encodings, content)
+            uploads.extend(f_uploads)
+            originals.extend(f_originals)
+
+    def _fingerprinted_uploads(self, f, encodings, content=None):
+        """Return the uploads of ``f`` under its fingerprinted name and the
+        ``(f, encoding, None, source)`` puts in the version.
+
+        ``content`` is the record put under the fingerprinted name if it
+        differs from ``f``, like CSS referencing fingerprinted names. The
+        originals are then uploaded, otherwise the fingerprinted key is
+        copied in S3.
+        """
+        if content is None:
+            content = f
+        dist = f['distribution']
+        digest = _file_digest(content)
+        path = _fingerprint_path(f['resource_path'], digest)
+        unchanged = self._fingerprints.unchanged(dist, f['resource_path'], path)
+        self._fingerprints.update(dist, f['resource_path'], path)
+        uploads = []
+        originals = []
+        for enc in encodings:
+            target = '/'.join([self._path, dist.project_name, _encoded_path(enc, path)])
+            if self._fingerprint_exists(target):
+                logging.debug("Fingerprint exists, skipping %s", target)
+            else:
+                uploads.append((content, enc, digest))
+            if unchanged:
+                # the version has it from an earlier run
+                logging.debug("Unchanged, skipping %s:%s", f['distribution_name'],
+                              _encoded_path(enc, f['resource_path']))
+                continue
+            # relative references, like the modules of a YUI group, find the
+            # files under their original name in the version
+            source = None
+            if content is f:
+                source = target
+            originals.append((f, enc, None, source))
+        return uploads, originals
+
+    def _upload_all(self, uploads, originals=()):
+        copies = []
+        present = []
+        if self._copy_unchanged:
+            uploads, copies, present = self._find_copies(uploads)
+        if self._jobs > 1:
+            # start the largest files first so the slowest upload does not
+            # hold up the end of the run
+            def size(upload):
+                return _file_size(upload[0])
+            uploads = sorted(uploads, key=size, reverse=True)
+        _map_threaded(self._upload, uploads, self._jobs)
+        # copies may be of files uploaded just now
+        _map_threaded(self._server_copy, copies, self._jobs)
+        _map_threaded(self._put_original, originals, self._jobs)
+        if self._manifest is not None and self._fingerprints is None:
+            for f, enc, digest in uploads + [c[:3] for c in copies] + present:
+                self._manifest.update(f['distribution'], _encoded_path(enc, f['resource_path']), digest)
+            self._manifest.save()
+
+    def _find_copies(self, uploads):
+        """Split uploads into the ones to send, to copy in S3 and already there.
+
+        Content already in S3, in any version of the project, or being
+        uploaded in the same batch is copied by S3 instead of sent again.
+        """
+        to_upload = []
+        copies = []
+        present = []
+        for upload in uploads:
+            f, enc, digest = upload
+            content = self._content(f, enc, digest)
+            sources = self._copy_sources(f['distribution'])
+            source = sources.get(content)
+            target = self._target(f, enc, digest)
+            if source is None:
+                # the copies are made after the uploads
+                sources[content] = target
+                to_upload.append(upload)
+            elif source == target:
+                logging.debug("Already in S3, skipping %s", target)
+                present.append(upload)
+            else:
+                copies.append((f, enc, digest, source))
+        return to_upload, copies, present
+
+    def _content(self, f, enc, digest):
+        # files under an encoding prefix are only encoded for some mimetypes
+        mimetype = _guess_type(f['resource_path'].split('/')[-1])
+        if enc is not None and self._should_encode(mimetype):
+            return enc, digest
+        return None, digest
+
+    def _copy_sources(self, dist):
+        """Map the (encoding, digest) of the project's files in S3 to a key.
+
+        The ETag of a key uploaded in one part is the MD5 of the content. The
+        digests of the sources of encoded files are found in the manifests.
+        """
+        prefix = '/'.join([self._path, dist.project_name, ''])
+        sources = self._sources.get(prefix)
+        if sources is not None:
+            return sources
+        logging.debug("S3: listing keys under %s to find copies", prefix)
+        sources = self._sources[prefix] = {}
+        manifests = []
+        for key in self._bucket.list(prefix=prefix):
+            etag = (key.etag or '').strip('"')
+            if key.name.endswith('/' + _MANIFEST_NAME):
+                manifests.append(key)
+            elif etag and '-' not in etag:
+                sources.setdefault((None, etag), key.name)
+        for key in manifests:
+            base = key.name[:-len(_MANIFEST_NAME)]
+            manifest = json.loads(key.get_contents_as_string().decode('utf-8'))
+            for path, digest in sorted(manifest.items()):
+                enc = path.split('/', 1)[0]
+                mimetype = _guess_type(path.split('/')[-1])
+                if '/' not in path or enc not in _ENCODERS or not self._should_encode(mimetype):
+                    enc = None
+                sources.setdefault((enc, digest), base + path)
+        return sources
+
+    def _target(self, f, enc, digest):
+        dist = f['distribution']
+        rpath = f['resource_path']
+        if self._fingerprints is not None and digest is not None:
+            prefix = '/'.join([self._path, dist.project_name])
+            rpath = _fingerprint_path(rpath, digest)
+        else:
+            # without a digest the original name in the version is wanted
+            prefix = '/'.join([self._path, dist.project_name, dist.version])
+        if enc is None:
+            return '/'.join([prefix, rpath])
+        elif enc in _ENCODERS:
+            return '/'.join([prefix, enc, rpath])
+        raise NotImplementedError(enc)
+
+    def _headers(self, f, enc):
+        mimetype = _guess_type(f['resource_path'].split('/')[-1])
+        headers = {'Cache-Control': 'max-age=32140800'}
+        if mimetype:
+            headers['Content-Type'] = mimetype
+        if enc is not None and self._should_encode(mimetype):
+            headers['Content-Encoding'] = enc
+        return headers
+
+    def _server_copy(self, copy):
+        f, enc, digest, source = copy
+        target = self._target(f, enc, digest)
+        headers = self._headers(f, enc)
+        headers['x-amz-acl'] = 'public-read'
+        logging.info("copying in S3: %s to %s with headers: %s", source, target, headers)
+        # metadata makes S3 use our headers instead of the source's
+        self._bucket.copy_key(
+                target, self._bucket_name, source,
+                metadata={},
+                storage_class='REDUCED_REDUNDANCY',
+                headers=headers)
+        self._indexed(target)
+
+    def _put_original(self, original):
+        f, enc, digest, source = original
+        if source is None:
+            self._upload((f, enc, digest))
+        else:
+            self._server_copy(original)
+
+    def _upload(self, upload):
+        f, enc, digest = upload
+        filename = f['resource_path'].split('/')[-1]
+        target = self._target(f, enc, digest)
+        headers = self._headers(f, enc)
+        encoded = None
+        if 'Content-Encoding' in headers:
+            encoded = SpooledTemporaryFile(_SPOOL_SIZE)
+            source = _open_file(f)
+            try:
+                _ENCODERS[enc](filename, source, encoded)
+            finally:
+                source.close()
+        logging.info("putting to S3: %s with headers: %s", target, headers)
+        key = self._get_key_class()(self._bucket)
+        key.key = target
+        if encoded is None:
+            size = _file_size(f)
+            if self._multipart_threshold is not None and size > self._multipart_threshold:
+                self._upload_multipart(target, f, size, headers)
+            elif f['filesystem_path'] is None:
+                # read from the archive, zip members can seek as boto needs
+                stream = _open_file(f)
+                try:
+                    key.set_contents_from_file(
+                            stream,
+                            reduced_redundancy=True,
+                            headers=headers,
+                            policy='public-read')
+                finally:
+                    stream.close()
+            else:
                 key.set_contents_from_filename(
-                        fs_path,
+                        f['filesystem_path'],
                         reduced_redundancy=True,
                         headers=headers,
                         policy='public-read')
+        else:
+            try:
+                encoded.seek(0)
+                key.set_contents_from_file(
+                        encoded,
+                        reduced_redundancy=True,
+                        headers=headers,
+                        policy='public-read')
+            finally:
+                encoded.close()
+        self._indexed(target)
+
+    def _upload_multipart(self, target, f, size, headers):
+        part_size = max(self._multipart_threshold, _MIN_PART_SIZE)
+        parts = []
+        offset = 0
+        while offset < size:
+            parts.append((len(parts) + 1, offset, min(part_size, size - offset)))
+            offset += part_size
+        logging.info("putting to S3 in %s parts: %s", len(parts), target)
+        mp = self._bucket.initiate_multipart_upload(
+                target,
+                headers=headers,
+                reduced_redundancy=True,
+                policy='public-read')
+        MultiPartUpload = self._get_multipart_class()
+        def upload_part(part):
+            part_num, offset, length = part
+            # the upload object is bound to the connection of this thread
+            thread_mp = MultiPartUpload(self._bucket)
+            thread_mp.key_name = mp.key_name
+            thread_mp.id = mp.id
+            for attempt in range(_PART_RETRIES):
+                fp = _open_file(f)
+                try:
+                    fp.seek(offset)
+                    try:
+                        thread_mp.upload_part_from_file(fp, part_num, size=length)
+                        return
+                    except Exception:
+                        if attempt == _PART_RETRIES - 1:
+                            raise
+                        logging.warning("Retrying part %s of %s", part_num, target)
+                finally:
+                    fp.close()
+        try:
+            _map_threaded(upload_part, parts, _PART_JOBS)
+        except:
+            mp.cancel_upload()
+            raise
+        mp.complete_upload()
+
+def _gzip_encode(filename, source, dest):
+    """Compress the file object ``source`` into ``dest`` chunk by chunk.
+
+    The modification time in the gzip header is zeroed so that the output
+    only depends on the input.
+    """
+    import gzip
+    file = gzip.GzipFile(filename, 'wb', 9, dest, 0)
+    try:
+        shutil.copyfileobj(source, file, _CHUNK_SIZE)
+    finally:
+        file.close()
+
+def _brotli_encode(filename, source, dest):
+    # lazy import to not have a hard dependency on brotli
+    import brotli
+    compressor = brotli.Compressor(quality=11)
+    for chunk in iter(lambda: source.read(_CHUNK_SIZE), b''):
+        dest.write(compressor.process(chunk))
+    dest.write(compressor.finish())
+
+def _zstd_encode(filename, source, dest):
+    # lazy import to not have a hard dependency on zstandard
+    import zstandard
+    compressor = zstandard.ZstdCompressor(level=19)
+    compressor.copy_stream(source, dest, read_size=_CHUNK_SIZE)
+
+# Content-Encoding: function to encode a file object into another
+_ENCODERS = {
+        'gzip': _gzip_encode,
+        'br': _brotli_encode,
+        'zstd': _zstd_encode}
+
+# Content-Encoding: suffix of the precompressed files on the local filesystem
+_ENCODING_SUFFIXES = {
+        'gzip': '.gz',
+        'br': '.br',
+        'zstd': '.zst'}
+
+def _encoded_path(encoding, path):
+    if encoding is None:
+        return path
+    return '/'.join([encoding, path])
+
+def _map_threaded(func, items, jobs):
+    """Call ``func`` with every item in ``items`` using up to ``jobs`` threads.
+
+    Items are started in the order given. After the first failure no new items
+    are started and the exception is re-raised once all threads are finished.
+    """
+    if jobs <= 1:
+        for item in items:
+            func(item)
+        return
+    try:
+        from queue import Queue, Empty
+    except ImportError:
+        #python 2
+        from Queue import Queue, Empty
+    queue = Queue()
+    for item in items:
+        queue.put(item)
+    errors = []
+    def worker():
+        while not errors:
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                func(item)
+            except:
+                logging.exception("Failed processing %r", item)
+                errors.append(sys.exc_info()[1])
+    threads = []
+    for i in range(min(jobs, queue.qsize())):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+class _ThreadedIterator:
+    """Iterate over ``iterator`` in a separate thread.
+
+    Up to ``maxsize`` items are read ahead into a queue. Chaining these
+    between the stages of the pipeline lets each stage work in its own
+    thread, so reading files, minifying and putting overlap while the queues
+    bound the number of records in flight. An exception in the thread is
+    re-raised by the consumer. ``close`` stops the thread early.
+    """
+
+    _done = object()
+
+    def __init__(self, iterator, maxsize):
+        try:
+            from queue import Queue
+        except ImportError:
+            #python 2
+            from Queue import Queue
+        self._queue = Queue(maxsize)
+        self._stopped = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, args=(iterator, ))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    return
+        except:
+            self._put((None, sys.exc_info()[1]))
+            return
+        self._put((self._done, None))
+
+    def _put(self, item):
+        try:
+            from queue import Full
+        except ImportError:
+            #python 2
+            from Queue import Full
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def __iter__(self):
+        return self
 
-def _to_dict(resource_path, filesystem_path, distribution_name, distribution, type):
+    def __next__(self):
+        try:
+            from queue import Empty
+        except ImportError:
+            #python 2
+            from Queue import Empty
+        while not self._finished and not self._stopped.is_set():
+            try:
+                item, error = self._queue.get(timeout=0.1)
+            except Empty:
+                continue
+            if error is not None:
+                self._finished = True
+                raise error
+            if item is self._done:
+                break
+            return item
+        self._finished = True
+        raise StopIteration()
+
+    next = __next__ # python 2
+
+    def stop(self):
+        self._stopped.set()
+
+    def close(self):
+        self.stop()
+        self._thread.join()
+
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy(source, target)
+
+def _to_dict(resource_path, filesystem_path, distribution_name, distribution, type,
+             size=None, mtime=None, stream=None):
     """Convert a tuple of values to a more plugin friendly dictionary.
 
     - `resource_path` is the path to file within resource (distribution)
     - `filesystem_path` is path to file on local filesystem
-    - `distribution` is the pkg_resources distribution object
-    - `distribution_name` is the pkg_resources distribution name
+    - `distribution` is the `_Distribution` with the project name and version
+    - `distribution_name` is the distribution name
     - `type` is a string indicating the resource type, `file` for a filesystem file and `dir` for a directory
+    - `size` and `mtime` are those of the file at `filesystem_path` when known, otherwise None
+    - `stream` is set with `filesystem_path` None for files read from an archive, its `open()` returns a file object
     """
     return locals()
 
-class _YUICompressor:
+def _replace_file(f, filesystem_path):
+    # a stage wrote a new file for the record, its size is not known yet
+    f['filesystem_path'] = filesystem_path
+    f['size'] = f['mtime'] = None
+    f['stream'] = None
+
+def _open_file(f):
+    if f.get('stream') is not None:
+        return f['stream'].open()
+    return open(f['filesystem_path'], 'rb')
+
+def _write_file(f, target):
+    """Write the content of the record ``f`` to ``target``."""
+    if os.path.exists(target):
+        # never write through a hard link to another file
+        os.remove(target)
+    source = _open_file(f)
+    try:
+        dest = open(target, 'wb')
+        try:
+            shutil.copyfileobj(source, dest, _CHUNK_SIZE)
+        finally:
+            dest.close()
+    finally:
+        source.close()
+
+def _file_size(f):
+    if f.get('size') is not None:
+        return f['size']
+    return os.path.getsize(f['filesystem_path'])
+
+class _Stage:
+    """Base class for the processing stages of the ``extract`` pipeline.
+
+    Sub-classes implement ``jobs`` which yields ``(records, job)`` tuples.
+    ``job`` is either None or a ``(function, args)`` tuple doing the actual
+    work. The function must be importable at module level so that it can be
+    run in another process by ``_parallel_process``. The records are passed
+    on down the pipeline once the job finished.
+
+    If ``cache`` is set to a ``_Cache``, stages describing their work with
+    ``cache_description`` re-use the output of earlier runs.
+
+    Stages declare where they run in the pipeline with ``order``, the files
+    they handle with ``extensions``, whether their jobs may run in another
+    process with ``parallel`` and whether their output may be cached with
+    ``cacheable``. Most stages only implement ``job``, the default ``jobs``
+    writes the output of every file handled to the stage's ``_tmpdir``.
+    """
+
+    order = 500
+    extensions = None
+    parallel = True
+    cacheable = True
+    cache = None
 
     def __init__(self):
         self._tmpdir = mkdtemp()
@@ -515,83 +1851,627 @@ class _YUICompressor:
 
     def dispose(self):
         if self._tmpdir is not None:
-            logging.debug("_YUICompressior: removing temp workspace: %s",
-                          self._tmpdir)
+            logging.debug("%s: removing temp workspace: %s",
+                          self.__class__.__name__, self._tmpdir)
             shutil.rmtree(self._tmpdir)
             self._tmpdir = None
 
+    def handles(self, f):
+        if f['type'] != 'file':
+            return False
+        return self.extensions is None or f['resource_path'].endswith(
+                tuple(self.extensions))
+
+    def target(self, f):
+        """Return the path in ``_tmpdir`` to write the output for ``f`` to."""
+        self._counter += 1
+        return os.path.join(self._tmpdir, '%s-%s' % (
+                self._counter, f['resource_path'].split('/')[-1]))
+
+    def job(self, f, source, target):
+        """Return the ``(function, args)`` job processing ``source`` of ``f``
+        to ``target``."""
+        raise NotImplementedError()
+
+    def jobs(self, files):
+        for f in files:
+            if not self.handles(f):
+                yield [f], None
+                continue
+            source = self.source(f)
+            target = self.target(f)
+            if self.from_cache(f, target):
+                _replace_file(f, target)
+                yield [f], None
+                continue
+            job = self.job(f, source, target)
+            _replace_file(f, target)
+            yield [f], job
+
+    def cache_description(self, f):
+        """Describe how ``f`` is processed, None if it can't be cached."""
+        return None
+
+    def from_cache(self, f, target):
+        """Write the processed ``f`` to ``target`` from the cache.
+
+        Returns False on a cache miss, the output is then stored in the cache
+        once the job processing it is done.
+        """
+        if self.cache is None:
+            return False
+        description = self.cache_description(f)
+        if description is None:
+            return False
+        return self.cache.get(f['filesystem_path'], description, target)
+
+    def job_done(self, records, result):
+        if self.cache is not None:
+            for f in records:
+                self.cache.store(f['filesystem_path'])
+
+    def source(self, f):
+        """Return the filesystem path of ``f`` to pass to a tool.
+
+        Files read from an archive are written to the stage's ``_tmpdir``
+        first.
+        """
+        if f['filesystem_path'] is None:
+            self._counter += 1
+            target = os.path.join(self._tmpdir, '%s-src-%s' % (
+                    self._counter, f['resource_path'].split('/')[-1]))
+            _write_file(f, target)
+            _replace_file(f, target)
+        return f['filesystem_path']
+
+    def process(self, files):
+        for records, job in self.jobs(files):
+            if job is not None:
+                func, args = job
+                self.job_done(records, func(*args))
+            for f in records:
+                yield f
+
+
+# the base class for stages registered by other packages
+Stage = _Stage
+
+
+class _Cache:
+    """A content addressed cache for the output of pipeline stages.
+
+    Entries are keyed by a hash of the input file and the description of the
+    processing the stage gives. Hits update the modification time of the
+    entry so that the least recently used entries are evicted by ``close``
+    once the cache is larger than ``max_size`` bytes.
+
+    Entries are copied in and out, never linked, as the output may be hard
+    linked into the target where its modification time is served.
+    """
+
+    def __init__(self, directory, max_size=None):
+        self._directory = directory
+        self._max_size = max_size
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, source, description):
+        import hashlib
+        h = hashlib.sha1()
+        h.update(description.encode('utf-8'))
+        h.update(b'\0')
+        f = open(source, 'rb')
+        try:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                h.update(chunk)
+        finally:
+            f.close()
+        key = h.hexdigest()
+        return os.path.join(self._directory, key[:2], key)
+
+    def get(self, source, description, target):
+        path = self._path(source, description)
+        try:
+            shutil.copy(path, target)
+        except (IOError, OSError):
+            self.misses += 1
+            self._pending[target] = path
+            return False
+        self.hits += 1
+        logging.debug("Cache hit for %s: %s", source, path)
+        os.utime(path, None)
+        return True
+
+    def store(self, output):
+        path = self._pending.pop(output, None)
+        if path is None:
+            return
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # write under a temporary name so readers never see a partial entry
+        handle, tmp = mkstemp(dir=dirname)
+        os.close(handle)
+        os.remove(tmp)
+        shutil.copy(output, tmp)
+        os.rename(tmp, path)
+
+    def close(self):
+        logging.info("Cache %s: %s hits, %s misses", self._directory,
+                     self.hits, self.misses)
+        if self._max_size is not None:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self._directory):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self._max_size:
+                break
+            logging.debug("Evicting %s from the cache", path)
+            os.remove(path)
+            total -= size
+
+
+def _parallel_process(stage, files, pool, max_pending):
+    """Run the jobs of ``stage`` in a multiprocessing pool.
+
+    At most ``max_pending`` jobs are queued ahead of the one being waited on
+    and records are yielded in the same order as ``stage.process`` would.
+    """
+    pending = deque()
+    def finish():
+        records, result = pending.popleft()
+        if result is not None:
+            try:
+                result = result.get()
+            except:
+                e = sys.exc_info()[1]
+                paths = ', '.join(['%s:%s' % (f['distribution_name'], f['resource_path'])
+                                   for f in records])
+                raise Exception('%s failed processing %s: %r' % (
+                    stage.__class__.__name__, paths, e))
+            stage.job_done(records, result)
+        return records
+    for records, job in stage.jobs(files):
+        if job is not None:
+            func, args = job
+            job = pool.apply_async(func, args)
+        pending.append((records, job))
+        while pending and (len(pending) > max_pending or pending[0][1] is None):
+            for f in finish():
+                yield f
+    while pending:
+        for f in finish():
+            yield f
+
+
+class _YUICompressor(_Stage):
+    """Minify JS and CSS files with the yui-compressor.
+
+    With a ``batch_size`` larger than 1, up to that many files are compressed
+    by a single yui-compressor process. This avoids paying the JVM start-up
+    once per file, but needs a yui-compressor which accepts multiple input
+    files.
+    """
+
+    order = 200
+    extensions = ('.js', '.css')
+
+    def __init__(self, batch_size=1):
+        _Stage.__init__(self)
+        self._batch_size = batch_size
+        self._startup_time = None
+        self._invocations = 0
+        self._compressed = 0
+        self._elapsed = 0.0
+
+    def dispose(self):
+        if self._tmpdir is not None and self._invocations:
+            self._log_timing()
+        _Stage.dispose(self)
+
     def __del__(self):
         if self._tmpdir is not None:
             raise Exception('%s was not disposed before garbage collection' % self)
         self.dispose()
 
-    def process(self, files):
+    def _log_timing(self):
+        msg = ("YUI Compressor: compressed %s files with %s invocations in "
+               "%.2fs") % (self._compressed, self._invocations, self._elapsed)
+        if self._startup_time is not None:
+            startup = self._startup_time * self._invocations
+            msg += (", of which %.2fs (%.2fs per invocation) was start-up "
+                    "and %.2fs compressing") % (
+                            startup, self._startup_time,
+                            max(self._elapsed - startup, 0.0))
+        logging.info(msg)
+
+    def _type(self, f):
+        rpath = f['resource_path']
+        if f['type'] == 'file' and rpath.endswith('.js'):
+            return 'js'
+        elif f['type'] == 'file' and rpath.endswith('.css'):
+            return 'css'
+        return None
+
+    def _job(self, calls, files):
+        if self._startup_time is None and logging.getLogger().isEnabledFor(logging.INFO):
+            # time compressing an empty file, which is all start-up
+            empty = os.path.join(self._tmpdir, 'startup.js')
+            open(empty, 'w').close()
+            self._startup_time = _yui_compress([(
+                ['yui-compressor', '--type', 'js', '-o', empty, empty], ())])
+        self._invocations += len(calls)
+        self._compressed += files
+        return _yui_compress, (calls, )
+
+    def job_done(self, records, result):
+        _Stage.job_done(self, records, result)
+        self._elapsed += result
+
+    def cache_description(self, f):
+        global _yui_version
+        if _yui_version is None:
+            p = subprocess.Popen(['yui-compressor', '-V'], stdout=subprocess.PIPE)
+            _yui_version = p.communicate()[0].decode('ascii', 'replace').strip()
+        return 'yui-compressor %s --type %s' % (_yui_version, self._type(f))
+
+    def job(self, f, source, target):
+        type = self._type(f)
+        args = ['yui-compressor', '--type', type, '-o', target, source]
+        logging.debug('Compressing with YUI Compressor %s file, '
+                      'from %s to %s', type, source, target)
+        return self._job([(args, ())], 1)
+
+    def jobs(self, files):
+        if self._batch_size > 1:
+            return self._batch_jobs(files)
+        return _Stage.jobs(self, files)
+
+    def _batch_jobs(self, files):
+        window = []
+        batches = {'js': [], 'css': []}
+        pending = 0
         for f in files:
-            rpath = f['resource_path']
-            f_type = f['type']
-            if f_type == 'file' and rpath.endswith('.js'):
-                type = 'js'
-            elif f_type == 'file' and rpath.endswith('.css'):
-                type = 'css'
-            else:
-                yield f
+            window.append(f)
+            type = self._type(f)
+            if type is None:
                 continue
-            self._counter += 1
-            fs_rpath = f['filesystem_path']
-            target = os.path.join(self._tmpdir, str(self._counter) + '-' +
-                                                os.path.basename(fs_rpath))
-            args = ['yui-compressor', '--type', type, '-o', target, fs_rpath]
-            logging.debug('Compressing with YUI Compressor %s file, '
-                          'from %s to %s', type, fs_rpath, target)
-            subprocess.check_call(args)
-            f['filesystem_path'] = target
-            yield f
+            self.source(f)
+            target = self.target(f)
+            if self.from_cache(f, target):
+                _replace_file(f, target)
+                continue
+            batches[type].append((f, target))
+            pending += 1
+            if pending >= self._batch_size:
+                yield window, self._batch_job(batches, pending)
+                window = []
+                batches = {'js': [], 'css': []}
+                pending = 0
+        if window:
+            yield window, self._batch_job(batches, pending)
+
+    def _batch_job(self, batches, files):
+        if not files:
+            return None
+        calls = []
+        for type in sorted(batches):
+            batch = batches[type]
+            if not batch:
+                continue
+            # yui-compressor writes each output next to its input as named
+            # by the -o pattern, so the inputs are staged as <target>.src
+            args = ['yui-compressor', '--type', type, '-o', r'^(.*)\.src$:$1']
+            staged = []
+            for f, target in batch:
+                staged.append((f['filesystem_path'], target + '.src'))
+                args.append(target + '.src')
+                _replace_file(f, target)
+            logging.debug('Compressing %s %s files with YUI Compressor',
+                          len(batch), type)
+            calls.append((args, staged))
+        return self._job(calls, files)
+
+
+_yui_version = None
+
+def _yui_compress(calls):
+    """Run yui-compressor once per call, returns the time it took.
+
+    Each call is a tuple of the command line and a list of ``(source,
+    staged)`` files to copy before running it.
+    """
+    start = time.time()
+    for args, staged in calls:
+        for source, copy in staged:
+            _link_or_copy(source, copy)
+        subprocess.check_call(args)
+        for source, copy in staged:
+            os.remove(copy)
+    return time.time() - start
+
+
+class _RJSMin(_Stage):
+    """Minify JS and CSS files in process with rjsmin and rcssmin.
+
+    No process is started per file, which makes it much faster than the
+    yui-compressor for many small files. Both packages fall back to pure
+    python if their C extensions are not built.
+    """
 
-class _CSSUtils:
-    """Filter to inline CSS @import statements"""
+    order = 200
+    extensions = ('.js', '.css')
 
-    def __init__(self, resolve_imports=False, minify=False):
-        if cssutils is None:
-            import cssutils as err # cssutils needs to be installed
-        self._tmpdir = mkdtemp()
-        self._counter = 0
-        self.serializer = cssutils.CSSSerializer()
-        self.resolve_imports = resolve_imports
-        if minify:
-            self.serializer.prefs.useMinified()
+    def __init__(self):
+        import rjsmin, rcssmin # rjsmin and rcssmin need to be installed
+        _Stage.__init__(self)
+        self._compressed = 0
+        self._elapsed = 0.0
 
     def dispose(self):
-        if self._tmpdir is not None:
-            logging.debug("_CSSImportInliner: removing temp workspace: %s",
-                          self._tmpdir)
-            shutil.rmtree(self._tmpdir)
-            self._tmpdir = None
+        if self._tmpdir is not None and self._compressed:
+            logging.info("rjsmin: minified %s files in %.2fs",
+                         self._compressed, self._elapsed)
+        _Stage.dispose(self)
+
+    def _type(self, f):
+        return f['resource_path'].rsplit('.', 1)[-1]
+
+    def cache_description(self, f):
+        type = self._type(f)
+        package = {'js': 'rjsmin', 'css': 'rcssmin'}[type]
+        version = _get_distribution(package).version
+        return '%s %s --type %s' % (package, version, type)
+
+    def job_done(self, records, result):
+        _Stage.job_done(self, records, result)
+        self._compressed += len(records)
+        self._elapsed += result
+
+    def job(self, f, source, target):
+        type = self._type(f)
+        logging.debug('Minifying %s file with rjsmin, from %s to %s',
+                      type, source, target)
+        return _rjsmin_process, (type, source, target)
+
+
+def _rjsmin_process(type, source, target):
+    """Minify ``source`` to ``target``, returns the time it took."""
+    start = time.time()
+    if type == 'js':
+        from rjsmin import jsmin as minify
+    else:
+        from rcssmin import cssmin as minify
+    in_f = open(source, 'rb')
+    try:
+        data = in_f.read()
+    finally:
+        in_f.close()
+    out_f = open(target, 'wb')
+    try:
+        out_f.write(minify(data))
+    finally:
+        out_f.close()
+    return time.time() - start
+
+
+class _YUIModules(_Stage):
+    """Write the YUI3 modules of the directories of JS files.
+
+    The modules are found from the original files, as
+    ``van.static.yui.find_modules`` does, and written next to them as
+    ``.van.static-yui-modules.json`` before the stamp of their resource.
+    Applications load it with ``van.static.yui.load_modules`` instead of
+    scanning the directory when they start.
+    """
+
+    order = 50
+    extensions = ('.js', )
+    parallel = False
+    cacheable = False
 
     def process(self, files):
+        from van.static import yui
+        found = {}
         for f in files:
-            if not f['resource_path'].endswith('.css') or f['type'] != 'file':
-                yield f
+            if f['type'] == 'stamp':
+                for record in self._modules_files(found):
+                    yield record
+                found = {}
+            dirname, _, filename = f['resource_path'].rpartition('/')
+            if filename == yui._MODULES_NAME:
+                # written again from the modules found
                 continue
-            self._counter += 1
-            fs_rpath = f['filesystem_path']
-            sheet = cssutils.parseFile(fs_rpath)
-            sheet.setSerializer(self.serializer)
-            for url in cssutils.getUrls(sheet):
-                u = urlparse(url)
-                if u.scheme or u.netloc or not u.path.startswith('./'):
-                    logging.warning('non-relative URL used in CSS: %s' % url)
-            if self.resolve_imports:
-                sheet = cssutils.resolveImports(sheet)
-            target = os.path.join(
-                    self._tmpdir,
-                    str(self._counter) + '-' + os.path.basename(fs_rpath))
-            out_f = open(target, 'wb')
+            if self.handles(f) and not filename.startswith('.'):
+                source = _open_file(f)
+                try:
+                    requires, error = yui._requires(source, '%s:%s' % (
+                            f['distribution_name'], f['resource_path']))
+                finally:
+                    source.close()
+                if error is not None:
+                    logging.warning(error)
+                k = (f['distribution_name'], dirname)
+                if k not in found:
+                    found[k] = (f['distribution'], {})
+                found[k][1][filename[:-3]] = dict(path=filename,
+                                                  requires=requires)
+            yield f
+        for record in self._modules_files(found):
+            yield record
+
+    def _modules_files(self, found):
+        from van.static import yui
+        for (pname, dirname), (dist, modules) in sorted(found.items()):
+            if not [m for m in modules.values() if m['requires'] is not None]:
+                # not a directory of YUI modules
+                continue
+            resource_path = '/'.join([dirname, yui._MODULES_NAME])
+            target = self.target(_to_dict(resource_path, None, pname, dist,
+                                          'file'))
+            f = open(target, 'w')
             try:
-                out_f.write(sheet.cssText)
+                f.write(json.dumps(modules, indent=0, sort_keys=True))
             finally:
-                out_f.close()
-            f['filesystem_path'] = target
+                f.close()
+            logging.debug("Writing YUI modules of %s:%s", pname, dirname)
+            yield _to_dict(resource_path, target, pname, dist, 'file')
+
+
+class _YUICombos(_Stage):
+    """Write the concatenated modules of YUI3 combos.
+
+    ``combos`` are ``package:path=module,module`` strings. The modules these
+    need are found from the ``.van.static-yui-modules.json`` written by the
+    yui-modules stage and concatenated in load order after minifying. The
+    combo is written next to the modules under the name
+    ``van.static.yui.combo_url`` gives it.
+    """
+
+    order = 300
+    extensions = ('.js', )
+    parallel = False
+    cacheable = False
+
+    def __init__(self, combos):
+        _Stage.__init__(self)
+        self._combos = {}
+        for combo in combos:
+            resource, entries = combo.split('=', 1)
+            pname, path = resource.split(':', 1)
+            self._combos.setdefault((pname, path.strip('/')), []).append(
+                    entries.split(','))
+
+    def process(self, files):
+        from van.static import yui
+        found = {}
+        records = {}
+        for f in files:
+            if f['type'] == 'stamp':
+                for record in self._combo_files(found, records):
+                    yield record
+                found = {}
+                records = {}
+            elif f['type'] == 'file':
+                dirname, _, filename = f['resource_path'].rpartition('/')
+                k = (f['distribution_name'], dirname)
+                if filename == yui._MODULES_NAME and k in self._combos:
+                    source = _open_file(f)
+                    try:
+                        modules = json.loads(source.read().decode('utf-8'))
+                    finally:
+                        source.close()
+                    found[k] = (f['distribution'], modules)
+                elif self.handles(f):
+                    # later stages may change the record
+                    records[(f['distribution_name'], f['resource_path'])] = dict(f)
             yield f
+        for record in self._combo_files(found, records):
+            yield record
+
+    def _combo_files(self, found, records):
+        from van.static import yui
+        for (pname, dirname), (dist, modules) in sorted(found.items()):
+            graph = yui.ModuleGraph(modules)
+            for entries in self._combos[(pname, dirname)]:
+                paths = yui._combo_paths(graph, entries)
+                contents = []
+                for p in paths:
+                    source = _open_file(records[(pname, '/'.join([dirname, p]))])
+                    try:
+                        contents.append(source.read())
+                    finally:
+                        source.close()
+                resource_path = '/'.join([dirname, yui._combo_name(paths)])
+                target = self.target(_to_dict(resource_path, None, pname,
+                                              dist, 'file'))
+                f = open(target, 'wb')
+                try:
+                    f.write(b'\n'.join(contents))
+                finally:
+                    f.close()
+                logging.debug("Writing YUI combo %s of %s:%s",
+                              resource_path, pname, ','.join(entries))
+                yield _to_dict(resource_path, target, pname, dist, 'file')
+
+
+class _CSSUtils(_Stage):
+    """Filter to inline CSS @import statements"""
+
+    order = 100
+    extensions = ('.css', )
+
+    def __init__(self, resolve_imports=False, minify=False):
+        import cssutils # cssutils needs to be installed
+        _Stage.__init__(self)
+        self.resolve_imports = resolve_imports
+        self.minify = minify
+
+    def cache_description(self, f):
+        if self.resolve_imports:
+            # the output depends on the imported files too
+            return None
+        version = _get_distribution('cssutils').version
+        return 'cssutils %s minify=%s' % (version, self.minify)
+
+    def source(self, f):
+        # files read from an archive are copied alone to the workspace, their
+        # imports are read from the archive
+        self._member = f['stream']
+        return _Stage.source(self, f)
+
+    def job(self, f, source, target):
+        args = (source, target, self.resolve_imports, self.minify)
+        if self.resolve_imports and isinstance(self._member, _ZipMember):
+            args += (self._member.archive, self._member.name)
+        return _cssutils_process, args
+
+
+def _cssutils_process(source, target, resolve_imports, minify, archive=None,
+                      member=None):
+    import cssutils
+    serializer = cssutils.CSSSerializer()
+    if minify:
+        serializer.prefs.useMinified()
+    if archive is None:
+        sheet = cssutils.parseFile(source)
+    else:
+        def fetch(url):
+            try:
+                from urllib.parse import unquote
+            except ImportError:
+                #python 2
+                from urllib import unquote
+            name = unquote(urlparse(url).path).lstrip('/')
+            try:
+                data = _zip_file(archive).read(name)
+            except KeyError:
+                return None
+            return None, data.decode('utf-8')
+        parser = cssutils.CSSParser(fetcher=fetch)
+        sheet = parser.parseFile(source, href='file:///' + member)
+    sheet.setSerializer(serializer)
+    for url in cssutils.getUrls(sheet):
+        u = urlparse(url)
+        if u.scheme or u.netloc or not u.path.startswith('./'):
+            logging.warning('non-relative URL used in CSS: %s' % url)
+    if resolve_imports:
+        sheet = cssutils.resolveImports(sheet)
+    out_f = open(target, 'wb')
+    try:
+        out_f.write(sheet.cssText)
+    finally:
+        out_f.close()
 
 
 if __name__ == "__main__":
@@ -21,6 +21,20 @@ def _iter_to_dict(i):
             e = _to_dict(*e)
         yield e
 
+class TestImport(TestCase):
+
+    def test_lazy(self):
+        # the extract command does not load pyramid and applications do not
+        # load the extraction dependencies
+        import subprocess
+        import van.static
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(van.static.__file__))))
+        code = ("import sys, van.static.cdn; "
+                "print(sorted(m for m in ['pyramid', 'cssutils', 'zipfile', 'optparse', 'pkg_resources'] if m in sys.modules))")
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(out.strip(), b('[]'))
+
+
 class TestExtractCmd(TestCase):
 
     @patch("van.static.cdn.logging")
@@ -71,6 +85,22 @@ class TestExtractCmd(TestCase):
                     '--cssutils-resolve-imports',
                     '--yui-compressor',
                     '--encoding', 'gzip',
+                    '--jobs', '4',
+                    '--manifest',
+                    '--fingerprint',
+                    '--copy-unchanged',
+                    '--blob-store',
+                    '--yui-batch-size', '20',
+                    '--rjsmin',
+                    '--yui-modules',
+                    '--yui-combo', 'van.static.tests:static=a,b',
+                    '--stage', 'mystage',
+                    '--processes', '4',
+                    '--queue-size', '8',
+                    '--cache-dir', '/var/cache/static',
+                    '--cache-size', '10',
+                    '--multipart-threshold', '16',
+                    '--s3-endpoint', 'http://localhost:9000',
                     '--aws-access-key', '1234',
                     '--aws-secret-key', '12345',
                     '--loglevel', 'DEBUG',
@@ -80,6 +110,22 @@ class TestExtractCmd(TestCase):
                 's3:///somewhere_else',
                 True,
                 encodings=['gzip'],
+                jobs=4,
+                manifest=True,
+                fingerprint=True,
+                copy_unchanged=True,
+                blob_store=True,
+                yui_batch_size=20,
+                rjsmin=True,
+                yui_modules=True,
+                yui_combos=['van.static.tests:static=a,b'],
+                stages=['mystage'],
+                processes=4,
+                queue_size=8,
+                cache_dir='/var/cache/static',
+                cache_size=10 * 1024 * 1024,
+                multipart_threshold=16 * 1024 * 1024,
+                s3_endpoint='http://localhost:9000',
                 aws_secret_key='12345',
                 aws_access_key='1234',
                 ignore_stamps=False,
@@ -148,7 +194,7 @@ class TestExtract(TestCase):
         extract(['r1', 'r2'], 'file:///path/to/local', True, ignore_stamps=True, another_kw=1)
         walk_resources.assert_called_once_with(['r1', 'r2'], _never_has_stamp, tmpdir)
         # comp was called
-        comp.assert_called_once_with()
+        comp.assert_called_once_with(batch_size=1)
         comp().process.assert_called_once_with(walk_resources())
         comp().dispose.assert_called_once_with()
         # and putter with the result of comp
@@ -170,6 +216,195 @@ class TestExtract(TestCase):
         # and putter with the result of _CSSUtils
         putter().put.assert_called_once_with(_CSSUtils().process())
 
+    @patch("van.static.cdn._get_putter")
+    @patch("van.static.cdn._YUICompressor")
+    @patch("van.static.cdn._RJSMin")
+    @patch("van.static.cdn._walk_resources")
+    def test_rjsmin(self, walk_resources, _RJSMin, comp, putter):
+        from van.static.cdn import extract
+        # rjsmin is used instead of the yui-compressor
+        extract(['r1', 'r2'], 'file:///path/to/local', True, ignore_stamps=True, rjsmin=True)
+        _RJSMin.assert_called_once_with()
+        _RJSMin().process.assert_called_once_with(walk_resources())
+        _RJSMin().dispose.assert_called_once_with()
+        self.assertFalse(comp.called)
+        putter().put.assert_called_once_with(_RJSMin().process())
+
+    def _entry_point(self, name, factory):
+        ep = Mock()
+        ep.name = name
+        ep.load.return_value = factory
+        return ep
+
+    @patch("van.static.cdn._compat.entry_points")
+    def test_builtin_stages(self, entry_points):
+        from van.static.cdn import _stages, _CSSUtils, _RJSMin, _YUICompressor, _YUIModules
+        stages = _stages(['cssutils', 'rjsmin', 'yui-compressor', 'yui-modules'])
+        self.assertEqual(stages['cssutils'], _CSSUtils)
+        self.assertEqual(stages['rjsmin'], _RJSMin)
+        self.assertEqual(stages['yui-compressor'], _YUICompressor)
+        self.assertEqual(stages['yui-modules'], _YUIModules)
+        # entry points are only looked at for other stages
+        self.assertFalse(entry_points.called)
+
+    @patch("van.static.cdn._compat.entry_points")
+    def test_entry_points_loaded(self, entry_points):
+        from van.static.cdn import _stages, _CSSUtils
+        broken = self._entry_point('broken', None)
+        broken.load.side_effect = ImportError('broken')
+        replacing = self._entry_point('cssutils', Mock())
+        mine = self._entry_point('mine', Mock())
+        entry_points.return_value = [broken, replacing, mine]
+        stages = _stages(['cssutils', 'mine'])
+        # only the stages asked for are loaded, built-ins are not replaced
+        self.assertEqual(stages, {'cssutils': _CSSUtils, 'mine': mine.load()})
+        self.assertFalse(broken.load.called)
+        self.assertFalse(replacing.load.called)
+
+    @patch("van.static.cdn._get_putter")
+    @patch("van.static.cdn._YUIModules")
+    @patch("van.static.cdn._walk_resources")
+    def test_yui_modules(self, walk_resources, _YUIModules, putter):
+        from van.static.cdn import extract
+        extract(['r1'], 'file:///path/to/local', False, ignore_stamps=True, yui_modules=True)
+        _YUIModules.assert_called_once_with()
+        _YUIModules().process.assert_called_once_with(walk_resources())
+        _YUIModules().dispose.assert_called_once_with()
+        putter().put.assert_called_once_with(_YUIModules().process())
+
+    @patch("van.static.cdn._get_putter")
+    @patch("van.static.cdn._YUICombos")
+    @patch("van.static.cdn._YUIModules")
+    @patch("van.static.cdn._walk_resources")
+    def test_yui_combos(self, walk_resources, _YUIModules, _YUICombos, putter):
+        from van.static.cdn import extract
+        _YUIModules().order = 50
+        _YUICombos().order = 300
+        extract(['r1'], 'file:///path/to/local', False, ignore_stamps=True, yui_combos=['p:js=a'])
+        # the modules are written for the combos
+        _YUIModules().process.assert_called_once_with(walk_resources())
+        _YUICombos.assert_called_with(combos=['p:js=a'])
+        _YUICombos().process.assert_called_once_with(_YUIModules().process())
+        putter().put.assert_called_once_with(_YUICombos().process())
+
+    @patch("van.static.cdn._compat.entry_points")
+    @patch("van.static.cdn._get_putter")
+    @patch("van.static.cdn._walk_resources")
+    def test_entry_point_stage(self, walk_resources, putter, entry_points):
+        from van.static.cdn import extract, Stage
+        class Upper(Stage):
+            order = 50
+            extensions = ('.css', )
+            def job(self, f, source, target):
+                data = open(source).read()
+                open(target, 'w').write(data.upper())
+                return None
+        entry_points.return_value = [self._entry_point('upper', Upper)]
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        walk_resources.return_value = iter(list(_iter_to_dict([
+            ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+            ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file')])))
+        out = []
+        def put(files):
+            for f in files:
+                out.append((f['resource_path'], open(f['filesystem_path']).read()))
+        putter().put.side_effect = put
+        extract(['r1'], 'file:///path/to/local', False, ignore_stamps=True,
+                cssutils_minify=True, stages=['upper'])
+        entry_points.assert_called_once_with('van.static.stages')
+        # the stage ran before cssutils which minified its output (and
+        # normalized the property names)
+        self.assertEqual(out[0], ('tests/example/css/example.css', '.EXAMPLE{width:80px}'))
+        # other files were not handled
+        self.assertEqual(out[1][0], 'tests/example/example.txt')
+        self.assertEqual(out[1][1], open(here + '/example/example.txt').read())
+
+    @patch("van.static.cdn._compat.entry_points")
+    @patch("van.static.cdn._get_putter")
+    @patch("van.static.cdn._walk_resources")
+    def test_unknown_stage(self, walk_resources, putter, entry_points):
+        from van.static.cdn import extract
+        entry_points.return_value = []
+        self.assertRaises(NotImplementedError, extract, ['r1'],
+                          'file:///path/to/local', False, ignore_stamps=True,
+                          stages=['unknown'])
+        self.assertTrue(putter().close.called)
+
+    @patch("multiprocessing.Pool")
+    @patch("van.static.cdn._parallel_process")
+    @patch("van.static.cdn._compat.entry_points")
+    @patch("van.static.cdn._get_putter")
+    @patch("van.static.cdn._walk_resources")
+    def test_stage_declarations(self, walk_resources, putter, entry_points, parallel_process, pool):
+        from van.static.cdn import extract, Stage
+        class Serial(Stage):
+            parallel = False
+            cacheable = False
+            process = Mock()
+        stage = Mock()
+        stage.order = 1000
+        entry_points.return_value = [
+                self._entry_point('serial', Serial),
+                self._entry_point('plain', Mock(return_value=stage))]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            extract(['r1'], 'file:///path/to/local', False, ignore_stamps=True,
+                    stages=['plain', 'serial'], processes=2, cache_dir=tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+        # the stage which can not run in parallel was not given to the pool
+        # or the cache and ran before the later ordered stage
+        self.assertFalse(parallel_process.called)
+        Serial.process.assert_called_once_with(walk_resources())
+        stage.process.assert_called_once_with(Serial.process())
+        putter().put.assert_called_once_with(stage.process())
+        stage.dispose.assert_called_once_with()
+
+    @patch("van.static.cdn._get_putter")
+    @patch("van.static.cdn._walk_resources")
+    def test_queue_size(self, walk_resources, putter):
+        import threading
+        from van.static.cdn import extract
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        walked = []
+        def walk(*args):
+            for f in _iter_to_dict([
+                    ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+                    ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file')]):
+                walked.append(threading.current_thread())
+                yield f
+        walk_resources.side_effect = walk
+        out = []
+        def put(files):
+            for f in files:
+                out.append((f['resource_path'], open(f['filesystem_path']).read()))
+        putter().put.side_effect = put
+        extract(['r1'], 'file:///path/to/local', False, ignore_stamps=True,
+                cssutils_minify=True, queue_size=1)
+        self.assertEqual([r for r, data in out], [
+            'tests/example/css/example.css', 'tests/example/example.txt'])
+        self.assertEqual(out[0][1], '.example{width:80px}')
+        # the resources were walked in another thread
+        self.assertFalse(threading.current_thread() in walked)
+
+    @patch("multiprocessing.Pool")
+    @patch("van.static.cdn._parallel_process")
+    @patch("van.static.cdn._get_putter")
+    @patch("van.static.cdn._walk_resources")
+    def test_processes(self, walk_resources, putter, parallel_process, pool):
+        from van.static.cdn import extract, _CSSUtils
+        extract(['r1', 'r2'], 'file:///path/to/local', yui_compressor=False, ignore_stamps=True, cssutils_minify=True, processes=3)
+        pool.assert_called_once_with(3)
+        args, kw = parallel_process.call_args
+        self.assertTrue(isinstance(args[0], _CSSUtils))
+        self.assertEqual(args[1:], (walk_resources(), pool(), 6))
+        putter().put.assert_called_once_with(parallel_process())
+        pool().terminate.assert_called_once_with()
+
     @patch("van.static.cdn.mkdtemp")
     @patch("van.static.cdn._get_putter")
     @patch("van.static.cdn._YUICompressor")
@@ -197,14 +432,37 @@ class TestGetPutter(TestCase):
         self.assertTrue(isinstance(p, _PutS3))
         p.close()
 
+    def test_target_options(self):
+        from van.static.cdn import _get_putter
+        # options of the other kind of target are refused
+        self.assertRaises(ValueError, _get_putter, 's3://bucket/whatever', blob_store=True)
+        self.assertRaises(ValueError, _get_putter, 'file:///tmp/whatever', multipart_threshold=16)
+        self.assertRaises(ValueError, _get_putter, 'file:///tmp/whatever', s3_endpoint='http://localhost:9000')
+        self.assertRaises(ValueError, _get_putter, 'file:///tmp/whatever', jobs=4)
+        self.assertRaises(ValueError, _get_putter, 'file:///tmp/whatever', copy_unchanged=True)
+        try:
+            _get_putter('s3://bucket/whatever', blob_store=True)
+        except ValueError:
+            e = sys.exc_info()[1]
+            self.assertEqual(str(e), '--blob-store is only supported for file:// targets')
+        # unless they are not set
+        p = _get_putter('file:///tmp/whatever', jobs=None, copy_unchanged=False, encodings=['gzip'])
+        p.close()
+        p = _get_putter('s3://bucket/whatever', blob_store=False, jobs=2)
+        p.close()
+
 class DummyStaticURLInfo:
     # copied from pyramid tests
     def __init__(self):
         self.added = []
+        self.cache_busters = []
 
     def add(self, config, name, spec, **kw):
         self.added.append((config, name, spec, kw))
 
+    def add_cache_buster(self, config, spec, cachebust, explicit=False):
+        self.cache_busters.append((spec, cachebust))
+
 class TestDirective(TestCase):
 
     def _one(self):
@@ -259,6 +517,72 @@ class TestDirective(TestCase):
         self.assertEqual(req.static_url('package1:path1/path2'), 'http://example.com/name1/path2')
         self.assertEqual(req.static_url('van.static:static_files/file1.js'), 'http://cdn.example.com/path/van.static/%s/static_files/file1.js' % version)
 
+    def test_cdn_fingerprint(self):
+        import json
+        from van.static.cdn import _get_distribution as get_distribution
+        from pyramid.config import Configurator
+        from pyramid.testing import DummyRequest
+        fd, manifest = tempfile.mkstemp()
+        f = os.fdopen(fd, 'w')
+        f.write(json.dumps({'static_files/css/main.css': 'static_files/css/main-0123456789ab.css',
+                            'other/file.js': 'other/file-0123456789ab.js'}))
+        f.close()
+        try:
+            config = Configurator(autocommit=True)
+            config.include('van.static.cdn')
+            config.add_cdn_view('http://cdn.example.com/path', 'van.static:static_files',
+                                encodings=['gzip'], manifest=manifest)
+        finally:
+            os.remove(manifest)
+        req = DummyRequest()
+        req.registry = config.registry
+        # the version is not in the url, the file name changes with the content instead
+        self.assertEqual(req.static_url('van.static:static_files/css/main.css'),
+                         'http://cdn.example.com/path/van.static/static_files/css/main-0123456789ab.css')
+        self.assertEqual(req.static_url('van.static:gzip/static_files/css/main.css'),
+                         'http://cdn.example.com/path/van.static/gzip/static_files/css/main-0123456789ab.css')
+        # paths not in the manifest, like directories, are found in the version
+        version = get_distribution('van.static').version
+        self.assertEqual(req.static_url('van.static:static_files/other.css'),
+                         'http://cdn.example.com/path/van.static/%s/static_files/other.css' % version)
+        self.assertEqual(req.static_url('van.static:static_files/js'),
+                         'http://cdn.example.com/path/van.static/%s/static_files/js' % version)
+        self.assertEqual(req.static_url('van.static:gzip/static_files/js'),
+                         'http://cdn.example.com/path/van.static/%s/gzip/static_files/js' % version)
+
+    @patch('van.static.cdn._load_fingerprints')
+    def test_cdn_fingerprint_from_cdn(self, load):
+        import pkg_resources
+        version = pkg_resources.get_distribution('van.static').version
+        load.return_value = {}
+        config = self._one()
+        config.add_cdn_view('http://cdn.example.com/path', 'van.static:static_files', manifest=True)
+        load.assert_called_once_with('http://cdn.example.com/path/van.static/%s/.van.static-fingerprints.json' % version)
+        self.assertEqual(
+                config.registry.settings['info'].added,
+                [(config, 'http://cdn.example.com/path/van.static/static_files', 'van.static:static_files', {})])
+        [(spec, cache_buster)] = config.registry.settings['info'].cache_busters
+        self.assertEqual(spec, 'van.static:static_files')
+
+    @patch('urllib.request.urlopen')
+    def test_load_fingerprints_timeout(self, urlopen):
+        import socket
+        from van.static.cdn import _load_fingerprints
+        urlopen.side_effect = socket.timeout('timed out')
+        url = 'http://cdn.example.com/path/van.static/1.0/.van.static-fingerprints.json'
+        try:
+            _load_fingerprints(url)
+        except IOError:
+            e = sys.exc_info()[1]
+            self.assertTrue(url in str(e), str(e))
+        else:
+            self.fail('IOError not raised')
+        urlopen.assert_called_once_with(url, timeout=10)
+
+    def test_no_cdn_fingerprint(self):
+        config = self._one()
+        self.assertRaises(NotImplementedError, config.add_cdn_view, 'name1', 'package1:path1', manifest=True)
+
 
 class TestConfigStatic(TestCase):
 
@@ -284,7 +608,7 @@ class TestConfigStatic(TestCase):
                 [('name1', 'van.static:path1'),
                     ('name2', 'mock:path2')],
                 static_cdn=cdn_url)
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         url1 = '%s/van.static/%s/path1' % (cdn_url, get_distribution('van.static').version)
         url2 = '%s/mock/%s/path2' % (cdn_url, get_distribution('mock').version)
         self.assertEqual(config.add_static_view.call_args_list,
@@ -300,8 +624,7 @@ class TestWalkResources(TestCase):
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
 
-    @patch('van.static.cdn.mkstemp')
-    def test_walk(self, mkstemp):
+    def _walk(self):
         from van.static.cdn import _walk_resources
         from tempfile import mkstemp as real_mkstemp
         temp_files = []
@@ -309,18 +632,21 @@ class TestWalkResources(TestCase):
             handle, filename = real_mkstemp(*args, **kw)
             temp_files.append(filename)
             return handle, filename
-        mkstemp.side_effect = record_temp_files
         has_stamp = Mock()
         has_stamp.return_value = False
-        i = _walk_resources([
-            'van.static:tests/example',
-            'van.static:tests/example/js'], has_stamp, self.tmpdir)
-        i = list(i)
-        from pkg_resources import get_distribution
+        mkstemp = patch('van.static.cdn.mkstemp', side_effect=record_temp_files)
+        mkstemp.start()
+        try:
+            i = list(_walk_resources([
+                'van.static:tests/example',
+                'van.static:tests/example/js'], has_stamp, self.tmpdir))
+        finally:
+            mkstemp.stop()
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         here = os.path.dirname(__file__)
         stamp_path1, stamp_path2 = temp_files
-        self.assertEqual(i, list(_iter_to_dict([
+        expected = list(_iter_to_dict([
             ('tests/example', here + '/example', 'van.static', dist, 'dir'),
             ('tests/example/css', here + '/example/css', 'van.static', dist, 'dir'),
             ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
@@ -330,16 +656,156 @@ class TestWalkResources(TestCase):
             ('tests/example/images/example.jpg', here + '/example/images/example.jpg', 'van.static', dist, 'file'),
             ('tests/example/js', here + '/example/js', 'van.static', dist, 'dir'),
             ('tests/example/js/example.js', here + '/example/js/example.js', 'van.static', dist, 'file'),
-            dict(resource_path='tests/example',
-                filesystem_path=stamp_path1,
-                distribution_name='van.static',
-                distribution=dist,
-                type='stamp'),
+            ('tests/example', stamp_path1, 'van.static', dist, 'stamp'),
             # the duplicate of js is from the declaration of 'van.static:tests/example/js'
             ('tests/example/js', here + '/example/js', 'van.static', dist, 'dir'),
             ('tests/example/js/example.js', here + '/example/js/example.js', 'van.static', dist, 'file'),
             ('tests/example/js', stamp_path2, 'van.static', dist, 'stamp'),
-            ])))
+            ]))
+        return i, expected
+
+    def test_walk(self):
+        i, expected = self._walk()
+        # the size and modification time of files are collected on the way
+        for f in expected:
+            if f['type'] == 'file':
+                st = os.stat(f['filesystem_path'])
+                f['size'] = st.st_size
+                f['mtime'] = st.st_mtime
+        self.assertEqual(i, expected)
+
+    @patch('os.scandir', None)
+    def test_walk_provider(self):
+        # without os.scandir (or for zipped distributions) the resources are
+        # walked with pkg_resources, sizes are not collected
+        i, expected = self._walk()
+        self.assertEqual(i, expected)
+
+    def test_walk_module(self):
+        # resources next to a module which is not a package
+        from van.static.cdn import _walk_files
+        os.mkdir(os.path.join(self.tmpdir, 'static'))
+        open(os.path.join(self.tmpdir, 'vanstatictestmod.py'), 'w').close()
+        f = open(os.path.join(self.tmpdir, 'static', 'a.css'), 'w')
+        f.write('.a {}')
+        f.close()
+        sys.path.insert(0, self.tmpdir)
+        try:
+            walked = [(r, type) for r, fs_r, type, extra in _walk_files('vanstatictestmod', 'static')]
+        finally:
+            sys.path.remove(self.tmpdir)
+            sys.modules.pop('vanstatictestmod', None)
+        self.assertEqual(walked, [('static', 'dir'), ('static/a.css', 'file')])
+
+
+class TestZippedDistribution(TestCase):
+    # resources of a zipped egg are read from the archive
+
+    def setUp(self):
+        import zipfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.egg = os.path.join(self.tmpdir, 'vanstatic_zipped-1.0-py%s.%s.egg' % sys.version_info[:2])
+        z = zipfile.ZipFile(self.egg, 'w', zipfile.ZIP_DEFLATED)
+        z.writestr('EGG-INFO/PKG-INFO', 'Metadata-Version: 1.0\nName: vanstatic_zipped\nVersion: 1.0\n')
+        z.writestr('vanstatic_zipped/__init__.py', '')
+        z.writestr('vanstatic_zipped/static/a.css', '.a {\n    color: red\n}\n')
+        z.writestr('vanstatic_zipped/static/sub/b.txt', 'b\n')
+        z.close()
+        sys.path.insert(0, self.egg)
+        from van.static.cdn import _get_distribution
+        self.dist = _get_distribution('vanstatic_zipped')
+
+    def tearDown(self):
+        from van.static.cdn import _ZIP_FILES
+        sys.path.remove(self.egg)
+        sys.modules.pop('vanstatic_zipped', None)
+        zf = _ZIP_FILES.pop(self.egg, None)
+        if zf is not None:
+            zf.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _walk(self):
+        from van.static.cdn import _walk_resources
+        files = [f for f in _walk_resources(['vanstatic_zipped:static'], Mock(return_value=False), self.tmpdir)
+                 if f['type'] != 'stamp']
+        return files
+
+    def test_walk(self):
+        from van.static.cdn import _ZipMember
+        files = self._walk()
+        self.assertEqual([(f['resource_path'], f['type'], f['filesystem_path'], f['size'], f['stream']) for f in files], [
+            ('static', 'dir', None, None, None),
+            ('static/a.css', 'file', None, 22, _ZipMember(self.egg, 'vanstatic_zipped/static/a.css')),
+            ('static/sub', 'dir', None, None, None),
+            ('static/sub/b.txt', 'file', None, 2, _ZipMember(self.egg, 'vanstatic_zipped/static/sub/b.txt'))])
+
+    def test_put_local(self):
+        import gzip
+        from van.static.cdn import _PutLocal
+        target = os.path.join(self.tmpdir, 'target')
+        one = _PutLocal('file://' + target, encodings=['gzip'])
+        one.put(iter(self._walk()))
+        d = os.path.join(target, self.dist.project_name, '1.0', 'static')
+        f = open(os.path.join(d, 'sub', 'b.txt'), 'r')
+        self.assertEqual(f.read(), 'b\n')
+        f.close()
+        f = gzip.open(os.path.join(d, 'a.css.gz'), 'rb')
+        self.assertEqual(f.read(), b('.a {\n    color: red\n}\n'))
+        f.close()
+
+    def test_cssutils_resolve_imports(self):
+        # imports are resolved from the archive
+        from van.static.cdn import _CSSUtils
+        import zipfile
+        z = zipfile.ZipFile(self.egg, 'a')
+        z.writestr('vanstatic_zipped/static/imports.css', '@import "./a.css";\n.imports {\n    color: blue\n}\n')
+        z.writestr('vanstatic_zipped/static/sub/nested.css', '@import "../a.css";\n')
+        z.close()
+        one = _CSSUtils(resolve_imports=True, minify=True)
+        try:
+            out = {}
+            for f in one.process(iter(self._walk())):
+                if f['resource_path'].endswith('.css'):
+                    fh = open(f['filesystem_path'], 'rb')
+                    out[f['resource_path']] = fh.read()
+                    fh.close()
+        finally:
+            one.dispose()
+        self.assertEqual(out, {
+            'static/a.css': b('.a{color:red}'),
+            'static/imports.css': b('.a{color:red}.imports{color:blue}'),
+            'static/sub/nested.css': b('.a{color:red}')})
+
+    @patch("van.static.cdn._PutS3._get_key_class")
+    @patch("van.static.cdn._PutS3._get_conn_class")
+    def test_put_s3(self, conn_class, key_class):
+        from van.static.cdn import _PutS3
+        contents = []
+        def set_contents(fp, **kw):
+            contents.append(fp.read())
+        key_class()().set_contents_from_file.side_effect = set_contents
+        putter = _PutS3('s3://mybucket/path', aws_access_key='key', aws_secret_key='secret')
+        putter.put(iter(self._walk()))
+        self.assertFalse(key_class()().set_contents_from_filename.called)
+        self.assertEqual(sorted(contents), [b('.a {\n    color: red\n}\n'), b('b\n')])
+
+    def test_stage(self):
+        # stages get a file written to their temporary directory
+        from van.static.cdn import _CSSUtils
+        one = _CSSUtils(minify=True)
+        try:
+            files = list(one.process(iter(self._walk())))
+            css = files[1]
+            self.assertEqual(css['resource_path'], 'static/a.css')
+            self.assertEqual(css['stream'], None)
+            self.assertTrue(css['filesystem_path'].startswith(one._tmpdir))
+            f = open(css['filesystem_path'], 'r')
+            self.assertEqual(f.read(), '.a{color:red}')
+            f.close()
+            # other files are still read from the archive
+            self.assertEqual(files[3]['filesystem_path'], None)
+        finally:
+            one.dispose()
 
 
 class TestPutLocalMixin:
@@ -361,7 +827,7 @@ class TestPutLocalMixin:
         # we can put to local twice without issue
         # https://github.com/jinty/van.static/issues/1
         here = os.path.dirname(__file__)
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         one = self.make_one()
         to_put = [
@@ -385,7 +851,7 @@ class TestPutLocalMixin:
 
     def test_put(self):
         here = os.path.dirname(__file__)
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         one = self.make_one()
         one.put(_iter_to_dict([
@@ -414,7 +880,7 @@ class TestPutLocalMixin:
 
     def test_exists(self):
         here = os.path.dirname(__file__)
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         one = self.make_one()
         self.assertFalse(one.exists(dist, 'example.txt'))
@@ -423,13 +889,210 @@ class TestPutLocalMixin:
             ]))
         self.assertTrue(one.exists(dist, 'example.txt'))
 
+    def test_manifest(self):
+        from van.static.cdn import _get_distribution as get_distribution
+        from van.static.cdn import _PutLocal
+        dist = get_distribution('van.static')
+        sources = tempfile.mkdtemp()
+        try:
+            def write(name, contents):
+                path = os.path.join(sources, name)
+                f = open(path, 'w')
+                f.write(contents)
+                f.close()
+                return path
+            to_put = list(_iter_to_dict([
+                ('static', sources, 'van.static', dist, 'dir'),
+                ('static/a.txt', write('a.txt', 'a'), 'van.static', dist, 'file'),
+                ('static/b.txt', write('b.txt', 'b'), 'van.static', dist, 'file'),
+                ]))
+            from van.static.cdn import _Manifest
+            one = self.make_one()
+            one._manifest = _Manifest(one._read, one._write)
+            self.assertFalse(one.has_stamp(dist, 'static'))
+            one.put(iter(to_put))
+            manifest = os.path.join(self._tmpdir, 'van.static', dist.version, '.van.static-manifest.json')
+            import json
+            f = open(manifest, 'r')
+            self.assertEqual(json.load(f), {
+                'static/a.txt': '0cc175b9c0f1b6a831c399e269772661',
+                'static/b.txt': '92eb5ffee6ae2fec3ad71c777531578f'})
+            f.close()
+            # a new putter only copies the changed file
+            os.remove(to_put[2]['filesystem_path'])
+            write('b.txt', 'changed')
+            one = _PutLocal('file://' + self._tmpdir, manifest=True)
+            copied = []
+            def copy(source, target):
+                copied.append(target)
+            one._copy = copy
+            one.put(iter(to_put))
+            self.assertEqual(copied, [os.path.join(self._tmpdir, 'van.static', dist.version, 'static', 'b.txt')])
+        finally:
+            shutil.rmtree(sources)
+
+    def test_encodings(self):
+        import gzip
+        import brotli
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        one = self.make_one()
+        one._encodings = ['gzip', 'br']
+        one.put(_iter_to_dict([
+            ('tests/example', here + '/example', 'van.static', dist, 'dir'),
+            ('tests/example/css', here + '/example/css', 'van.static', dist, 'dir'),
+            ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+            ('tests/example/images', here + '/example/images', 'van.static', dist, 'dir'),
+            ('tests/example/images/example.jpg', here + '/example/images/example.jpg', 'van.static', dist, 'file'),
+            ]))
+        d = os.path.join(self._tmpdir, 'van.static', dist.version, 'tests', 'example')
+        self.assertEqual(sorted(os.listdir(os.path.join(d, 'css'))),
+                ['example.css', 'example.css.br', 'example.css.gz'])
+        # images are not compressed
+        self.assertEqual(os.listdir(os.path.join(d, 'images')), ['example.jpg'])
+        css = b('.example {\n\twidth: 80px\n}\n')
+        f = gzip.open(os.path.join(d, 'css', 'example.css.gz'), 'rb')
+        try:
+            self.assertEqual(f.read(), css)
+        finally:
+            f.close()
+        f = open(os.path.join(d, 'css', 'example.css.br'), 'rb')
+        try:
+            self.assertEqual(brotli.decompress(f.read()), css)
+        finally:
+            f.close()
+
+    def test_fingerprint(self):
+        import json
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        from van.static.cdn import _PutLocal
+        dist = get_distribution('van.static')
+        one = _PutLocal('file://' + self._tmpdir, encodings=['gzip'], fingerprint=True)
+        to_put = list(_iter_to_dict([
+            ('tests/example', here + '/example', 'van.static', dist, 'dir'),
+            ('tests/example/css', here + '/example/css', 'van.static', dist, 'dir'),
+            ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+            ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file'),
+            ]))
+        self.assertFalse(one.has_stamp(dist, 'tests/example'))
+        one.put(iter(to_put))
+        # the files are put outside the version
+        d = os.path.join(self._tmpdir, 'van.static', 'tests', 'example')
+        self.assertEqual(sorted(os.listdir(os.path.join(d, 'css'))),
+                ['example-a588f75ac878.css', 'example-a588f75ac878.css.gz'])
+        self.assertEqual(sorted(os.listdir(d)),
+                ['css', 'example-89333b2b5551.txt', 'example-89333b2b5551.txt.gz'])
+        # and under their original name in the version
+        d = os.path.join(self._tmpdir, 'van.static', dist.version, 'tests', 'example')
+        self.assertEqual(sorted(os.listdir(os.path.join(d, 'css'))),
+                ['example.css', 'example.css.gz'])
+        self.assertEqual(sorted(os.listdir(d)),
+                ['css', 'example.txt', 'example.txt.gz'])
+        f = open(os.path.join(self._tmpdir, 'van.static', dist.version, '.van.static-fingerprints.json'), 'r')
+        self.assertEqual(json.load(f), {
+            'tests/example/css/example.css': 'tests/example/css/example-a588f75ac878.css',
+            'tests/example/example.txt': 'tests/example/example-89333b2b5551.txt'})
+        f.close()
+        # files which are there already are not put again
+        one = _PutLocal('file://' + self._tmpdir, encodings=['gzip'], fingerprint=True)
+        copied = []
+        one._copy = lambda source, target: copied.append(target)
+        one._encode = lambda enc, source, target: copied.append(target)
+        one.put(iter(to_put))
+        self.assertEqual(copied, [])
+
+    def test_fingerprint_references(self):
+        import json
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        from van.static.cdn import _PutLocal
+        dist = get_distribution('van.static')
+        sources = {
+            'a.css': ('@import "b.css";\n'
+                      '.a { background: url("../images/example.jpg?v=1#x") }\n'
+                      '.d { background: url(data:image/png;base64,AAAA) }\n'
+                      '.h { background: url(http://example.com/x.png) }\n'),
+            'b.css': '.b { background: url(../images/example.jpg) }\n'}
+        for name, css in sources.items():
+            f = open(os.path.join(self._tmpdir, name), 'w')
+            f.write(css)
+            f.close()
+        target = os.path.join(self._tmpdir, 'target')
+        one = _PutLocal('file://' + target, fingerprint=True)
+        # a.css is walked before the css it imports
+        one.put(_iter_to_dict([
+            ('tests/css/a.css', os.path.join(self._tmpdir, 'a.css'), 'van.static', dist, 'file'),
+            ('tests/css/b.css', os.path.join(self._tmpdir, 'b.css'), 'van.static', dist, 'file'),
+            ('tests/images/example.jpg', here + '/example/images/example.jpg', 'van.static', dist, 'file'),
+            ]))
+        f = open(os.path.join(target, 'van.static', dist.version, '.van.static-fingerprints.json'), 'r')
+        fingerprints = json.load(f)
+        f.close()
+        def read(*path):
+            f = open(os.path.join(target, 'van.static', *path), 'r')
+            try:
+                return f.read()
+            finally:
+                f.close()
+        name = lambda path: fingerprints[path].split('/')[-1]
+        image = name('tests/images/example.jpg')
+        # the fingerprinted css references the fingerprinted names
+        self.assertEqual(read(*fingerprints['tests/css/b.css'].split('/')),
+                         '.b { background: url(../images/%s) }\n' % image)
+        self.assertEqual(read(*fingerprints['tests/css/a.css'].split('/')),
+                         '@import "%s";\n'
+                         '.a { background: url("../images/%s?v=1#x") }\n'
+                         '.d { background: url(data:image/png;base64,AAAA) }\n'
+                         '.h { background: url(http://example.com/x.png) }\n' % (name('tests/css/b.css'), image))
+        self.assertTrue(os.path.exists(os.path.join(target, 'van.static', 'tests', 'images', image)))
+        # the css in the version is not changed, the files it references are there
+        self.assertEqual(read(dist.version, 'tests', 'css', 'a.css'), sources['a.css'])
+        self.assertEqual(read(dist.version, 'tests', 'css', 'b.css'), sources['b.css'])
+        self.assertTrue(os.path.exists(os.path.join(target, 'van.static', dist.version, 'tests', 'images', 'example.jpg')))
+        one.close()
+
+    def test_blob_store(self):
+        import gzip
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        other = Mock()
+        other.project_name = 'other'
+        other.version = '2.0'
+        one = self.make_one()
+        one._blobs = os.path.join(self._tmpdir, '.blobs')
+        one._encodings = ['gzip']
+        one.put(_iter_to_dict([
+            ('tests', here + '/example', 'van.static', dist, 'dir'),
+            ('tests/example.txt', here + '/example/example.txt', 'van.static', dist, 'file'),
+            ('copy.txt', here + '/example/example.txt', 'other', other, 'file'),
+            ]))
+        blob = os.path.join(self._tmpdir, '.blobs', '89', '89333b2b55518765e0735d5925e017a5')
+        self.assertEqual(sorted(os.listdir(os.path.dirname(blob))),
+                ['89333b2b55518765e0735d5925e017a5', '89333b2b55518765e0735d5925e017a5.gz'])
+        targets = [os.path.join(self._tmpdir, 'van.static', dist.version, 'tests', 'example.txt'),
+                   os.path.join(self._tmpdir, 'other', '2.0', 'copy.txt')]
+        for target in targets:
+            f = open(target, 'r')
+            self.assertEqual(f.read(), 'Example Text\n')
+            f.close()
+            f = gzip.open(target + '.gz', 'rb')
+            self.assertEqual(f.read(), b('Example Text\n'))
+            f.close()
+            if one._hard_link:
+                # the files are the blobs
+                self.assertTrue(os.path.samefile(target, blob))
+                self.assertTrue(os.path.samefile(target + '.gz', blob + '.gz'))
+
 
 class TestPutLocal(TestPutLocalMixin, TestCase):
 
     @patch('os.link')
     @patch('shutil.copy')
     def test_fallback_to_copy(self, copy, link):
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         one = self.make_one()
         to_put = [
@@ -450,6 +1113,20 @@ class TestPutLocal(TestPutLocalMixin, TestCase):
         self.assertEqual(link.call_count, 1)
         self.assertEqual(copy.call_count, 2)
 
+    def test_stamp_with_encodings(self):
+        from van.static.cdn import _get_distribution as get_distribution
+        from van.static.cdn import _PutLocal
+        one = _PutLocal('file://' + self._tmpdir, encodings=['gzip'])
+        dist = get_distribution('pyramid')
+        stamp_dist = get_distribution('van.static')
+        exists = one.exists = Mock()
+        one.has_stamp(dist, 'static')
+        exists.assert_called_once_with(stamp_dist, 'pyramid-%s-gzip-ON2GC5DJMM======.stamp' % dist.version)
+
+    def test_unknown_encoding(self):
+        from van.static.cdn import _PutLocal
+        self.assertRaises(NotImplementedError, _PutLocal, 'file://' + self._tmpdir, encodings=['deflate'])
+
 
 class TestPutLocalNoHardlink(TestPutLocalMixin, TestCase):
     """Run all TestPutLocalMixin tests with hard linking disabled"""
@@ -463,27 +1140,38 @@ class TestPutLocalNoHardlink(TestPutLocalMixin, TestCase):
 
 class TestPutS3(TestCase):
 
+    @patch("van.static.cdn._PutS3._get_key_class")
     @patch("van.static.cdn._PutS3._get_conn_class")
-    def test_exists(self, conn_class):
+    def test_exists(self, conn_class, key_class):
         conn = Mock()
         conn_class.return_value = conn
         target_url = 's3://mybucket/path/to/dir'
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         here = os.path.dirname(__file__)
         from van.static.cdn import _PutS3
         putter = _PutS3(target_url, aws_access_key='key', aws_secret_key='secret')
         bucket = conn().get_bucket()
-        bucket.get_key.return_value = None
+        prefix = '/path/to/dir/%s/%s/' % (dist.project_name, dist.version)
+        existing = Mock()
+        existing.name = prefix + 'whatever/exists'
+        bucket.list.return_value = [existing]
         self.assertFalse(putter.exists(dist, 'whatever/wherever'))
-        bucket.get_key.assert_called_once_with('/path/to/dir/%s/%s/whatever/wherever' % (dist.project_name, dist.version))
-        bucket.get_key.return_value = 'not none'
+        self.assertTrue(putter.exists(dist, 'whatever/exists'))
+        # the prefix was listed only once
+        bucket.list.assert_called_once_with(prefix=prefix)
+        self.assertFalse(bucket.get_key.called)
+        # keys we put are added to the index
+        putter.put(_iter_to_dict([
+            ('whatever/wherever', here + '/example/example.txt', 'van.static', dist, 'file'),
+            ]))
         self.assertTrue(putter.exists(dist, 'whatever/wherever'))
+        self.assertEqual(bucket.list.call_count, 1)
         putter.close()
 
     @patch("van.static.cdn._PutS3.exists")
     def test_has_stamp(self, exists):
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         from van.static.cdn import _PutS3
         target_url = 's3://mybucket/path/to/dir'
         putter = _PutS3(target_url, aws_access_key='key', aws_secret_key='secret')
@@ -495,7 +1183,7 @@ class TestPutS3(TestCase):
 
     @patch("van.static.cdn._PutS3.exists")
     def test_has_stamp_with_encodings(self, exists):
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         from van.static.cdn import _PutS3
         target_url = 's3://mybucket/path/to/dir'
         putter = _PutS3(target_url, aws_access_key='key', aws_secret_key='secret', encodings=['gzip', 'deflate'])
@@ -519,7 +1207,7 @@ class TestPutS3(TestCase):
         conn_class.return_value = conn
         key_class.return_value = key
         target_url = 's3://mybucket/path/to/dir'
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         here = os.path.dirname(__file__)
         from van.static.cdn import _PutS3
@@ -561,13 +1249,19 @@ class TestPutS3(TestCase):
     @patch("van.static.cdn._PutS3._get_conn_class")
     def test_put_encodings(self, conn_class, key_class):
         keys = []
+        uploaded = []
+        upload_kw = []
         def record_keys(bucket):
             mock = Mock()
+            def read_file(fp, **kw):
+                uploaded.append(fp.read())
+                upload_kw.append(kw)
+            mock.set_contents_from_file.side_effect = read_file
             keys.append(mock)
             return mock
         key_class().side_effect = record_keys
         target_url = 's3://mybucket/path/to/dir'
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         here = os.path.dirname(__file__)
         from van.static.cdn import _PutS3
@@ -589,20 +1283,18 @@ class TestPutS3(TestCase):
         self.assertEqual(
                 css_gz_key.key,
                 '/path/to/dir/van.static/%s/gzip/tests/example/css/example.css' % dist.version)
-        args, kw = css_gz_key.set_contents_from_filename.call_args
+        args, kw = css_gz_key.set_contents_from_file.call_args
+        self.assertFalse(css_gz_key.set_contents_from_filename.called)
         # the file uploaded was a gzipped version of the CSS
-        self.assertNotEqual(here + '/example/css/example.css', args[0])
+        self.assertEqual(upload_kw, [kw])
+        self.assertTrue(uploaded[0].startswith(b('\x1f\x8b'))) # gzip magic number
         import gzip
-        f = open(args[0], 'rb')
+        from io import BytesIO
+        gz_f = gzip.GzipFile('', 'r', fileobj=BytesIO(uploaded[0]))
         try:
-            file_contents = f.read()
-            f.seek(0)
-            gz_f = gzip.GzipFile('', 'r', fileobj=f)
             decoded_css = gz_f.read()
         finally:
-            f.close()
             gz_f.close()
-        self.assertTrue(file_contents.startswith(b('\x1f\x8b'))) # gzip magic number
         self.assertEqual(decoded_css.decode('ascii'), '.example {\n\twidth: 80px\n}\n')
         self.assertEqual(kw, dict(
                 reduced_redundancy=True,
@@ -631,10 +1323,129 @@ class TestPutS3(TestCase):
                 policy='public-read')
         putter.close()
 
+    @patch("van.static.cdn._PutS3._get_key_class")
+    @patch("van.static.cdn._PutS3._get_conn_class")
+    def test_put_brotli_zstd(self, conn_class, key_class):
+        keys = []
+        uploaded = {}
+        def record_keys(bucket):
+            mock = Mock()
+            def read_file(fp, **kw):
+                uploaded[mock.key] = fp.read(), kw['headers']
+            mock.set_contents_from_file.side_effect = read_file
+            keys.append(mock)
+            return mock
+        key_class().side_effect = record_keys
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _PutS3
+        putter = _PutS3('s3://mybucket/path', aws_access_key='key', aws_secret_key='secret', encodings=['br', 'zstd'])
+        putter.put(_iter_to_dict([
+            ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+            ]))
+        prefix = '/path/van.static/%s/' % dist.version
+        self.assertEqual([k.key for k in keys], [
+            prefix + 'tests/example/css/example.css',
+            prefix + 'br/tests/example/css/example.css',
+            prefix + 'zstd/tests/example/css/example.css'])
+        import brotli
+        import zstandard
+        data, headers = uploaded[prefix + 'br/tests/example/css/example.css']
+        self.assertEqual(headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(data), b('.example {\n\twidth: 80px\n}\n'))
+        data, headers = uploaded[prefix + 'zstd/tests/example/css/example.css']
+        self.assertEqual(headers['Content-Encoding'], 'zstd')
+        self.assertEqual(zstandard.ZstdDecompressor().decompressobj().decompress(data), b('.example {\n\twidth: 80px\n}\n'))
+        putter.close()
+
+    @patch("van.static.cdn._PutS3._get_key_class")
+    @patch("van.static.cdn._PutS3._get_conn_class")
+    def test_put_unknown_encoding(self, conn_class, key_class):
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _PutS3
+        putter = _PutS3('s3://mybucket/path', aws_access_key='key', aws_secret_key='secret', encodings=['deflate'])
+        self.assertRaises(NotImplementedError, putter.put, _iter_to_dict([
+            ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+            ]))
+        putter.close()
+
+    def _put_multipart(self, conn_class, key_class, multipart_class, fail):
+        import threading
+        lock = threading.Lock()
+        parts = {}
+        attempts = []
+        def upload_part(fp, part_num, size):
+            lock.acquire()
+            try:
+                attempts.append(part_num)
+                if fail(part_num, attempts):
+                    raise IOError('boom')
+                parts[part_num] = fp.read(size)
+            finally:
+                lock.release()
+        multipart_class()().upload_part_from_file.side_effect = upload_part
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _PutS3
+        putter = _PutS3('s3://mybucket/path', aws_access_key='key', aws_secret_key='secret',
+                        multipart_threshold=4)
+        bucket = conn_class()().get_bucket()
+        try:
+            putter.put(_iter_to_dict([
+                ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+                ]))
+        finally:
+            putter.close()
+        return bucket, parts, attempts
+
+    @patch("van.static.cdn._MIN_PART_SIZE", 4)
+    @patch("van.static.cdn._PutS3._get_multipart_class")
+    @patch("van.static.cdn._PutS3._get_key_class")
+    @patch("van.static.cdn._PutS3._get_conn_class")
+    def test_put_multipart(self, conn_class, key_class, multipart_class):
+        def fail(part_num, attempts):
+            # the first attempt of part 2 fails
+            return part_num == 2 and attempts.count(2) == 1
+        bucket, parts, attempts = self._put_multipart(conn_class, key_class, multipart_class, fail)
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        bucket.initiate_multipart_upload.assert_called_once_with(
+                '/path/van.static/%s/tests/example/css/example.css' % dist.version,
+                headers={'Cache-Control': 'max-age=32140800',
+                    'Content-Type': 'text/css'},
+                reduced_redundancy=True,
+                policy='public-read')
+        self.assertEqual(sorted(attempts), [1, 2, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(b('').join([parts[i] for i in sorted(parts)]),
+                b('.example {\n\twidth: 80px\n}\n'))
+        self.assertEqual(parts[7], b('}\n'))
+        mp = bucket.initiate_multipart_upload()
+        mp.complete_upload.assert_called_once_with()
+        self.assertFalse(mp.cancel_upload.called)
+        # the small file was not uploaded in one go
+        self.assertFalse(key_class()().set_contents_from_filename.called)
+
+    @patch("van.static.cdn.logging")
+    @patch("van.static.cdn._MIN_PART_SIZE", 4)
+    @patch("van.static.cdn._PutS3._get_multipart_class")
+    @patch("van.static.cdn._PutS3._get_key_class")
+    @patch("van.static.cdn._PutS3._get_conn_class")
+    def test_put_multipart_failure(self, conn_class, key_class, multipart_class, logging):
+        def fail(part_num, attempts):
+            return part_num == 3
+        self.assertRaises(IOError, self._put_multipart, conn_class, key_class, multipart_class, fail)
+        mp = conn_class()().get_bucket().initiate_multipart_upload()
+        mp.cancel_upload.assert_called_once_with()
+        self.assertFalse(mp.complete_upload.called)
+
     @patch("van.static.cdn._PutS3._get_key_class")
     @patch("van.static.cdn._PutS3._get_conn_class")
     def test_put_stamp(self, conn_class, key_class):
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         from van.static.cdn import _PutS3
         target_url = 's3://mybucket/path/to/dir'
         putter = _PutS3(target_url, aws_access_key='key', aws_secret_key='secret')
@@ -670,7 +1481,7 @@ class TestPutS3(TestCase):
     @patch("van.static.cdn._PutS3._get_key_class")
     @patch("van.static.cdn._PutS3._get_conn_class")
     def test_put_stamp_with_encoding(self, conn_class, key_class):
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         from van.static.cdn import _PutS3
         target_url = 's3://mybucket/path/to/dir'
         putter = _PutS3(target_url, aws_access_key='key', aws_secret_key='secret', encodings=['gzip'])
@@ -691,6 +1502,270 @@ class TestPutS3(TestCase):
                 (stamp_dist.version, dist.version))
         os.remove(tempfile)
 
+    @patch("van.static.cdn._PutS3._get_key_class")
+    @patch("van.static.cdn._PutS3._get_conn_class")
+    def test_put_jobs(self, conn_class, key_class):
+        import threading
+        lock = threading.Lock()
+        uploaded = []
+        def record_upload(bucket):
+            key = Mock()
+            def set_contents(*args, **kw):
+                lock.acquire()
+                try:
+                    uploaded.append(key.key)
+                finally:
+                    lock.release()
+            key.set_contents_from_filename.side_effect = set_contents
+            return key
+        key_class().side_effect = record_upload
+        from van.static.cdn import _get_distribution as get_distribution
+        from van.static.cdn import _PutS3
+        dist = get_distribution('van.static')
+        here = os.path.dirname(__file__)
+        putter = _PutS3('s3://mybucket/path', aws_access_key='key', aws_secret_key='secret', jobs=3)
+        from tempfile import mkstemp
+        f, stamp = mkstemp()
+        os.close(f)
+        putter.put(_iter_to_dict([
+            ('tests/example', here + '/example', 'van.static', dist, 'dir'),
+            ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file'),
+            ('tests/example/images/example.jpg', here + '/example/images/example.jpg', 'van.static', dist, 'file'),
+            ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+            ('tests/example', stamp, 'van.static', dist, 'stamp'),
+            ]))
+        os.remove(stamp)
+        prefix = '/path/van.static/%s/' % dist.version
+        # all files were uploaded and the stamp was written last
+        self.assertEqual(sorted(uploaded[:3]), [
+            prefix + 'tests/example/css/example.css',
+            prefix + 'tests/example/example.txt',
+            prefix + 'tests/example/images/example.jpg'])
+        self.assertTrue(uploaded[3].endswith('.stamp'))
+        self.assertEqual(len(uploaded), 4)
+        putter.close()
+
+    @patch("van.static.cdn.logging")
+    @patch("van.static.cdn._PutS3._get_key_class")
+    @patch("van.static.cdn._PutS3._get_conn_class")
+    def test_put_jobs_failure(self, conn_class, key_class, logging):
+        keys = []
+        def record_keys(bucket):
+            key = Mock()
+            def set_contents(*args, **kw):
+                if key.key.endswith('example.css'):
+                    raise IOError('boom')
+            key.set_contents_from_filename.side_effect = set_contents
+            keys.append(key)
+            return key
+        key_class().side_effect = record_keys
+        from van.static.cdn import _get_distribution as get_distribution
+        from van.static.cdn import _PutS3
+        dist = get_distribution('van.static')
+        here = os.path.dirname(__file__)
+        putter = _PutS3('s3://mybucket/path', aws_access_key='key', aws_secret_key='secret', jobs=2)
+        self.assertRaises(IOError, putter.put, _iter_to_dict([
+            ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file'),
+            ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+            ('tests/example', here + '/example/example.txt', 'van.static', dist, 'stamp'),
+            ]))
+        # the stamp was never written
+        self.assertTrue(keys)
+        for key in keys:
+            self.assertFalse(key.key.endswith('.stamp'))
+        putter.close()
+
+    @patch("van.static.cdn._PutS3._get_key_class")
+    @patch("van.static.cdn._PutS3._get_conn_class")
+    def test_put_manifest(self, conn_class, key_class):
+        import json
+        keys = []
+        def record_keys(bucket):
+            key = Mock()
+            keys.append(key)
+            return key
+        key_class().side_effect = record_keys
+        from van.static.cdn import _get_distribution as get_distribution
+        from van.static.cdn import _PutS3
+        dist = get_distribution('van.static')
+        here = os.path.dirname(__file__)
+        bucket = conn_class()().get_bucket()
+        manifest_key = Mock()
+        manifest_key.get_contents_as_string.return_value = json.dumps({
+            'tests/example/css/example.css': 'a588f75ac878e7e53a7765ed5046907f',
+            'gzip/tests/example/css/example.css': 'a588f75ac878e7e53a7765ed5046907f',
+            'tests/example/example.txt': 'not the same'}).encode('ascii')
+        bucket.get_key.return_value = manifest_key
+        listed_manifest = Mock()
+        listed_manifest.name = '/path/van.static/%s/.van.static-manifest.json' % dist.version
+        bucket.list.return_value = [listed_manifest]
+        putter = _PutS3('s3://mybucket/path', aws_access_key='key', aws_secret_key='secret',
+                        encodings=['gzip'], manifest=True)
+        self.assertFalse(putter.has_stamp(dist, 'tests/example'))
+        putter.put(_iter_to_dict([
+            ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+            ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file'),
+            ]))
+        prefix = '/path/van.static/%s/' % dist.version
+        bucket.get_key.assert_called_once_with(prefix + '.van.static-manifest.json')
+        txt_key, txt_gz_key, manifest = keys
+        self.assertEqual(txt_key.key, prefix + 'tests/example/example.txt')
+        self.assertEqual(txt_gz_key.key, prefix + 'gzip/tests/example/example.txt')
+        self.assertEqual(manifest.key, prefix + '.van.static-manifest.json')
+        args, kw = manifest.set_contents_from_string.call_args
+        self.assertEqual(json.loads(args[0].decode('utf-8')), {
+            'tests/example/css/example.css': 'a588f75ac878e7e53a7765ed5046907f',
+            'gzip/tests/example/css/example.css': 'a588f75ac878e7e53a7765ed5046907f',
+            'tests/example/example.txt': '89333b2b55518765e0735d5925e017a5',
+            'gzip/tests/example/example.txt': '89333b2b55518765e0735d5925e017a5'})
+        putter.close()
+
+    @patch("van.static.cdn._PutS3._get_key_class")
+    @patch("van.static.cdn._PutS3._get_conn_class")
+    def test_put_fingerprint(self, conn_class, key_class):
+        import json
+        keys = []
+        def record_keys(bucket):
+            key = Mock()
+            keys.append(key)
+            return key
+        key_class().side_effect = record_keys
+        from van.static.cdn import _get_distribution as get_distribution
+        from van.static.cdn import _PutS3
+        dist = get_distribution('van.static')
+        here = os.path.dirname(__file__)
+        bucket = conn_class()().get_bucket()
+        # the css was put by an earlier version
+        listed = Mock()
+        listed.name = '/path/van.static/tests/example/css/example-a588f75ac878.css'
+        bucket.list.return_value = [listed]
+        bucket.get_key.return_value = None
+        putter = _PutS3('s3://mybucket/path', aws_access_key='key', aws_secret_key='secret',
+                        fingerprint=True)
+        putter.put(_iter_to_dict([
+            ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+            ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file'),
+            ('tests/example', here + '/example/example.txt', 'van.static', dist, 'stamp'),
+            ]))
+        txt_key, fingerprints, stamp = keys
+        self.assertEqual(txt_key.key, '/path/van.static/tests/example/example-89333b2b5551.txt')
+        # S3 copies the fingerprinted files to their original names in the version
+        self.assertEqual(sorted(c[0][:3] for c in bucket.copy_key.call_args_list), [
+            ('/path/van.static/%s/tests/example/css/example.css' % dist.version, 'mybucket',
+             '/path/van.static/tests/example/css/example-a588f75ac878.css'),
+            ('/path/van.static/%s/tests/example/example.txt' % dist.version, 'mybucket',
+             '/path/van.static/tests/example/example-89333b2b5551.txt')])
+        self.assertEqual(fingerprints.key, '/path/van.static/%s/.van.static-fingerprints.json' % dist.version)
+        args, kw = fingerprints.set_contents_from_string.call_args
+        self.assertEqual(json.loads(args[0].decode('utf-8')), {
+            'tests/example/css/example.css': 'tests/example/css/example-a588f75ac878.css',
+            'tests/example/example.txt': 'tests/example/example-89333b2b5551.txt'})
+        self.assertTrue(stamp.key.endswith('-fingerprint-ORSXG5DTF5SXQYLNOBWGK===.stamp'), stamp.key)
+        putter.close()
+
+    @patch("van.static.cdn._PutS3._get_key_class")
+    @patch("van.static.cdn._PutS3._get_conn_class")
+    def test_put_copy_unchanged(self, conn_class, key_class):
+        import json
+        keys = []
+        def record_keys(bucket):
+            key = Mock()
+            keys.append(key)
+            return key
+        key_class().side_effect = record_keys
+        from van.static.cdn import _get_distribution as get_distribution
+        from van.static.cdn import _PutS3
+        dist = get_distribution('van.static')
+        here = os.path.dirname(__file__)
+        bucket = conn_class()().get_bucket()
+        # an earlier version has example.txt and the gzipped example.css
+        old_txt = Mock()
+        old_txt.name = '/path/van.static/0.1/tests/example/example.txt'
+        old_txt.etag = '"89333b2b55518765e0735d5925e017a5"'
+        old_manifest = Mock()
+        old_manifest.name = '/path/van.static/0.1/.van.static-manifest.json'
+        old_manifest.etag = '"0123"'
+        old_manifest.get_contents_as_string.return_value = json.dumps({
+            'tests/example/example.txt': '89333b2b55518765e0735d5925e017a5',
+            'gzip/tests/example/css/example.css': 'a588f75ac878e7e53a7765ed5046907f'}).encode('ascii')
+        bucket.list.return_value = [old_txt, old_manifest]
+        putter = _PutS3('s3://mybucket/path', aws_access_key='key', aws_secret_key='secret',
+                        encodings=['gzip'], copy_unchanged=True)
+        putter.put(_iter_to_dict([
+            ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+            ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file'),
+            ('tests/example/copy.txt', here + '/example/example.txt', 'van.static', dist, 'file'),
+            ]))
+        bucket.list.assert_called_once_with(prefix='/path/van.static/')
+        prefix = '/path/van.static/%s/' % dist.version
+        # only content which is not in S3 yet is uploaded
+        self.assertEqual(sorted([k.key for k in keys]), [
+            prefix + 'gzip/tests/example/example.txt',
+            prefix + 'tests/example/css/example.css'])
+        copies = sorted([(args[0], args[2], kw['headers']) for args, kw in bucket.copy_key.call_args_list])
+        self.assertEqual(copies, [
+            (prefix + 'gzip/tests/example/copy.txt', prefix + 'gzip/tests/example/example.txt',
+             {'Cache-Control': 'max-age=32140800', 'Content-Type': 'text/plain',
+              'Content-Encoding': 'gzip', 'x-amz-acl': 'public-read'}),
+            (prefix + 'gzip/tests/example/css/example.css', '/path/van.static/0.1/gzip/tests/example/css/example.css',
+             {'Cache-Control': 'max-age=32140800', 'Content-Type': 'text/css',
+              'Content-Encoding': 'gzip', 'x-amz-acl': 'public-read'}),
+            (prefix + 'tests/example/copy.txt', '/path/van.static/0.1/tests/example/example.txt',
+             {'Cache-Control': 'max-age=32140800', 'Content-Type': 'text/plain', 'x-amz-acl': 'public-read'}),
+            (prefix + 'tests/example/example.txt', '/path/van.static/0.1/tests/example/example.txt',
+             {'Cache-Control': 'max-age=32140800', 'Content-Type': 'text/plain', 'x-amz-acl': 'public-read'})])
+        putter.close()
+
+    @patch("van.static.cdn._PutS3._get_key_class")
+    @patch("van.static.cdn._PutS3._get_conn_class")
+    def test_put_fingerprint_unchanged(self, conn_class, key_class):
+        import json
+        from van.static.cdn import _get_distribution as get_distribution
+        from van.static.cdn import _PutS3
+        dist = get_distribution('van.static')
+        here = os.path.dirname(__file__)
+        bucket = conn_class()().get_bucket()
+        # an earlier run put the same version
+        listed = Mock()
+        listed.name = '/path/van.static/tests/example/example-89333b2b5551.txt'
+        bucket.list.return_value = [listed]
+        bucket.get_key().get_contents_as_string.return_value = json.dumps({
+            'tests/example/example.txt': 'tests/example/example-89333b2b5551.txt'}).encode('ascii')
+        putter = _PutS3('s3://mybucket/path', aws_access_key='key', aws_secret_key='secret',
+                        fingerprint=True)
+        putter.put(_iter_to_dict([
+            ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file'),
+            ]))
+        self.assertFalse(bucket.copy_key.called)
+        self.assertFalse(key_class()().set_contents_from_filename.called)
+        putter.close()
+
+
+class TestGzipEncode(TestCase):
+
+    def test_chunked(self):
+        import gzip
+        from io import BytesIO
+        from van.static.cdn import _gzip_encode, _CHUNK_SIZE
+        data = b('x') * (_CHUNK_SIZE * 3 + 1)
+        outputs = []
+        for i in range(2):
+            source = BytesIO(data)
+            reads = []
+            orig_read = source.read
+            def read(size=-1):
+                reads.append(size)
+                return orig_read(size)
+            source.read = read
+            dest = BytesIO()
+            _gzip_encode('example.js', source, dest)
+            # the source was never read in one go
+            self.assertTrue(-1 not in reads, reads)
+            outputs.append(dest.getvalue())
+        # the output only depends on the input
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(outputs[0])).read(), data)
+
 
 class TestYUICompressor(TestCase):
 
@@ -705,7 +1780,7 @@ class TestYUICompressor(TestCase):
     def test_uncompressible(self, subprocess):
         # directories and non js/css
         here = os.path.dirname(__file__)
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         input = list(_iter_to_dict(
             [('tests/example/css', here + '/example/css', 'van.static', dist, 'dir'),
@@ -717,7 +1792,7 @@ class TestYUICompressor(TestCase):
     def test_compress(self, subprocess):
         # js/css files are compressed to a temporary directory
         here = os.path.dirname(__file__)
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         input = list(_iter_to_dict([('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
                  ('tests/example/js/example.js', here + '/example/js/example.js', 'van.static', dist, 'file')]))
@@ -728,6 +1803,242 @@ class TestYUICompressor(TestCase):
             ((['yui-compressor', '--type', 'css', '-o', self.one._tmpdir + '/1-example.css', here + '/example/css/example.css'], ), ),
             ((['yui-compressor', '--type', 'js', '-o', self.one._tmpdir + '/2-example.js', here + '/example/js/example.js'], ), )])
 
+    @patch('van.static.cdn.subprocess')
+    def test_compress_batch(self, subprocess):
+        # many files are compressed by one yui-compressor per type
+        self.one.dispose()
+        from van.static.cdn import _YUICompressor
+        self.one = _YUICompressor(batch_size=10)
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        input = list(_iter_to_dict([('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+                 ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file'),
+                 ('tests/example/js/example.js', here + '/example/js/example.js', 'van.static', dist, 'file'),
+                 ('tests/example/css/example_imported.css', here + '/example/css/example_imported.css', 'van.static', dist, 'file')]))
+        tmp = self.one._tmpdir
+        out = list(_iter_to_dict([('tests/example/css/example.css', tmp + '/1-example.css', 'van.static', dist, 'file'),
+                 ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file'),
+                 ('tests/example/js/example.js', tmp + '/2-example.js', 'van.static', dist, 'file'),
+                 ('tests/example/css/example_imported.css', tmp + '/3-example_imported.css', 'van.static', dist, 'file')]))
+        self.assertEqual(list(self.one.process(iter(input))), out)
+        self.assertEqual(subprocess.check_call.call_args_list, [
+            ((['yui-compressor', '--type', 'css', '-o', r'^(.*)\.src$:$1', tmp + '/1-example.css.src', tmp + '/3-example_imported.css.src'], ), ),
+            ((['yui-compressor', '--type', 'js', '-o', r'^(.*)\.src$:$1', tmp + '/2-example.js.src'], ), )])
+        # the staged inputs were cleaned up
+        self.assertEqual(os.listdir(tmp), [])
+
+    @patch('van.static.cdn.logging')
+    @patch('van.static.cdn.subprocess')
+    def test_startup_timing(self, subprocess, logging):
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        input = list(_iter_to_dict([('tests/example/js/example.js', here + '/example/js/example.js', 'van.static', dist, 'file')]))
+        list(self.one.process(iter(input)))
+        # start-up was measured once by compressing an empty file
+        startup = self.one._tmpdir + '/startup.js'
+        self.assertEqual(subprocess.check_call.call_args_list[0],
+            ((['yui-compressor', '--type', 'js', '-o', startup, startup], ), ))
+        self.assertEqual(subprocess.check_call.call_count, 2)
+        self.one.dispose()
+        msg = logging.info.call_args[0][0]
+        self.assertTrue(msg.startswith('YUI Compressor: compressed 1 files with 1 invocations'), msg)
+        self.assertTrue('per invocation) was start-up' in msg, msg)
+
+class TestRJSMin(TestCase):
+
+    def setUp(self):
+        from van.static.cdn import _RJSMin
+        self.one = _RJSMin()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.one.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_uncompressible(self):
+        # directories and non js/css
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        input = list(_iter_to_dict(
+            [('tests/example/css', here + '/example/css', 'van.static', dist, 'dir'),
+             ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file')]))
+        self.assertEqual(list(self.one.process(iter(input))), input)
+
+    def test_minify(self):
+        # js/css files are minified in process to a temporary directory
+        here = os.path.dirname(__file__)
+        js = os.path.join(self.tmpdir, 'example.js')
+        f = open(js, 'w')
+        try:
+            f.write('/* comment */\nvar example = function (a) {\n    return a + 1;\n};\n')
+        finally:
+            f.close()
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        input = list(_iter_to_dict([('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+                 ('tests/example/js/example.js', js, 'van.static', dist, 'file')]))
+        tmp = self.one._tmpdir
+        out = list(_iter_to_dict([('tests/example/css/example.css', tmp + '/1-example.css', 'van.static', dist, 'file'),
+               ('tests/example/js/example.js', tmp + '/2-example.js', 'van.static', dist, 'file')]))
+        self.assertEqual(list(self.one.process(iter(input))), out)
+        f = open(tmp + '/1-example.css', 'r')
+        try:
+            self.assertEqual(f.read(), '.example{width:80px}')
+        finally:
+            f.close()
+        f = open(tmp + '/2-example.js', 'r')
+        try:
+            self.assertEqual(f.read(), 'var example=function(a){return a+1;};')
+        finally:
+            f.close()
+
+    def test_cache(self):
+        from van.static.cdn import _Cache
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        self.one.cache = _Cache(self.tmpdir)
+        input = list(_iter_to_dict([('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file')]))
+        list(self.one.process(iter(input)))
+        input = list(_iter_to_dict([('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file')]))
+        list(self.one.process(iter(input)))
+        self.assertEqual((self.one.cache.hits, self.one.cache.misses), (1, 1))
+
+
+class TestYUIModules(TestCase):
+
+    def setUp(self):
+        from van.static.cdn import _YUIModules
+        self.one = _YUIModules()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.one.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        f = open(path, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        return path
+
+    def test_process(self):
+        import json
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        a = self.write('a.js', "YUI.add('a', function (Y) {\n}, '1', { requires: ['node'] });\n")
+        b = self.write('b.js', "var b;\n")
+        old = self.write('old.json', "{}")
+        here = os.path.dirname(__file__)
+        input = list(_iter_to_dict([
+            ('static', self.tmpdir, 'van.static', dist, 'dir'),
+            ('static/js', self.tmpdir, 'van.static', dist, 'dir'),
+            ('static/js/a.js', a, 'van.static', dist, 'file'),
+            ('static/js/b.js', b, 'van.static', dist, 'file'),
+            ('static/js/.van.static-yui-modules.json', old, 'van.static', dist, 'file'),
+            ('static/example.js', here + '/example/js/example.js', 'van.static', dist, 'file'),
+            ('static', self.tmpdir + '/stamp', 'van.static', dist, 'stamp')]))
+        out = list(self.one.process(iter(input)))
+        # the modules file was added before the stamp, replacing the one
+        # found
+        self.assertEqual([f['resource_path'] for f in out], [
+            'static',
+            'static/js',
+            'static/js/a.js',
+            'static/js/b.js',
+            'static/example.js',
+            'static/js/.van.static-yui-modules.json',
+            'static'])
+        self.assertEqual(out[2:5], input[2:4] + input[5:6])
+        modules = out[5]
+        self.assertEqual(modules['type'], 'file')
+        self.assertEqual(modules['distribution'], dist)
+        f = open(modules['filesystem_path'], 'rb')
+        try:
+            data = json.loads(f.read().decode('utf-8'))
+        finally:
+            f.close()
+        self.assertEqual(data, {
+            'a': {'path': 'a.js', 'requires': ['node']},
+            'b': {'path': 'b.js', 'requires': None}})
+        # which is what find_modules loads
+        from van.static import yui
+        try:
+            self.assertRaises(Exception, yui.load_modules, 'van.static:static/js', modules['filesystem_path'])
+            import warnings
+            w = warnings.catch_warnings(record=True)
+            w.__enter__()
+            try:
+                yui.load_modules('van.static:static/js', modules['filesystem_path'], fail_onerror=False)
+            finally:
+                w.__exit__()
+            self.assertEqual(yui.find_modules('van.static:static/js'), data)
+        finally:
+            yui._MODULE_CACHE.pop('van.static:static/js', None)
+
+
+class TestYUICombos(TestCase):
+
+    def setUp(self):
+        from van.static.cdn import _YUIModules, _YUICombos
+        self.modules = _YUIModules()
+        self.one = _YUICombos(['van.static:static/js=c', 'van.static:static/js=b,a'])
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.one.dispose()
+        self.modules.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        f = open(path, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        return path
+
+    def test_process(self):
+        from van.static.cdn import _get_distribution as get_distribution
+        from van.static.yui import _combo_name
+        dist = get_distribution('van.static')
+        a = self.write('a.js', "YUI.add('a', function (Y) {\n}, '1', { requires: ['node'] });")
+        b = self.write('b.js', "YUI.add('b', function (Y) {\n}, '1', { requires: ['a'] });")
+        c = self.write('c.js', "YUI.add('c', function (Y) {\n}, '1', { requires: ['b'] });")
+        input = list(_iter_to_dict([
+            ('static/js', self.tmpdir, 'van.static', dist, 'dir'),
+            ('static/js/a.js', a, 'van.static', dist, 'file'),
+            ('static/js/b.js', b, 'van.static', dist, 'file'),
+            ('static/js/c.js', c, 'van.static', dist, 'file'),
+            ('static', self.tmpdir + '/stamp', 'van.static', dist, 'stamp')]))
+        out = list(self.one.process(self.modules.process(iter(input))))
+        combo = _combo_name(['a.js', 'b.js', 'c.js'])
+        self.assertEqual([f['resource_path'] for f in out], [
+            'static/js',
+            'static/js/a.js',
+            'static/js/b.js',
+            'static/js/c.js',
+            'static/js/.van.static-yui-modules.json',
+            'static/js/' + combo,
+            'static/js/' + _combo_name(['a.js', 'b.js']),
+            'static'])
+        f = open(out[5]['filesystem_path'], 'r')
+        try:
+            self.assertEqual(f.read(),
+                "YUI.add('a', function (Y) {\n}, '1', { requires: ['node'] });\n"
+                "YUI.add('b', function (Y) {\n}, '1', { requires: ['a'] });\n"
+                "YUI.add('c', function (Y) {\n}, '1', { requires: ['b'] });")
+        finally:
+            f.close()
+
+
 class TestCSSUtils(TestCase):
 
     def setUp(self):
@@ -746,7 +2057,7 @@ class TestCSSUtils(TestCase):
     def test_uncompressible(self):
         # directories and non css
         here = os.path.dirname(__file__)
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         input = list(_iter_to_dict(
             [('tests/example/css', here + '/example/css', 'van.static', dist, 'dir'),
@@ -759,7 +2070,7 @@ class TestCSSUtils(TestCase):
         # css files are compressed to a temporary directory
         one = self.one(minify=True)
         here = os.path.dirname(__file__)
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         input = list(_iter_to_dict([('tests/example/css/example_imported.css', here + '/example/css/example_imported.css', 'van.static', dist, 'file')]))
         outfile = one._tmpdir + '/1-example_imported.css'
@@ -774,7 +2085,7 @@ class TestCSSUtils(TestCase):
     def test_resolve_imports(self):
         one = self.one(resolve_imports=True, minify=True)
         here = os.path.dirname(__file__)
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         input = list(_iter_to_dict([('tests/example/css/example_imported.css', here + '/example/css/example_imported.css', 'van.static', dist, 'file')]))
         outfile = one._tmpdir + '/1-example_imported.css'
@@ -786,6 +2097,225 @@ class TestCSSUtils(TestCase):
         finally:
             f.close()
 
+class TestThreadedIterator(TestCase):
+
+    def test_iterate(self):
+        import threading
+        from van.static.cdn import _ThreadedIterator
+        threads = []
+        def produce():
+            for i in range(10):
+                threads.append(threading.current_thread())
+                yield i
+        it = _ThreadedIterator(produce(), 2)
+        self.assertEqual(list(it), list(range(10)))
+        self.assertRaises(StopIteration, next, it)
+        it.close()
+        self.assertFalse(threading.current_thread() in threads)
+
+    def test_error(self):
+        from van.static.cdn import _ThreadedIterator
+        def produce():
+            yield 1
+            raise ValueError('broken')
+        it = _ThreadedIterator(produce(), 2)
+        self.assertEqual(next(it), 1)
+        self.assertRaises(ValueError, next, it)
+        it.close()
+
+    def test_backpressure(self):
+        import time
+        from van.static.cdn import _ThreadedIterator
+        produced = []
+        def produce():
+            for i in range(100):
+                produced.append(i)
+                yield i
+        it = _ThreadedIterator(produce(), 2)
+        time.sleep(0.3)
+        # the producer waits once the queue is full
+        self.assertTrue(len(produced) <= 3, produced)
+        self.assertEqual(next(it), 0)
+        # and stops when closed
+        it.close()
+        self.assertTrue(len(produced) < 100, produced)
+        self.assertRaises(StopIteration, next, it)
+
+    def test_close_chain(self):
+        from van.static.cdn import _ThreadedIterator
+        def produce():
+            i = 0
+            while True:
+                yield i
+                i += 1
+        first = _ThreadedIterator(produce(), 1)
+        second = _ThreadedIterator((i * 2 for i in first), 1)
+        self.assertEqual(next(second), 0)
+        self.assertEqual(next(second), 2)
+        # stopping all first lets a consumer blocked on an upstream queue end
+        first.stop()
+        second.stop()
+        first.close()
+        second.close()
+
+
+class TestParallelProcess(TestCase):
+
+    def setUp(self):
+        import multiprocessing
+        from van.static.cdn import _CSSUtils
+        self.pool = multiprocessing.Pool(2)
+        self.one = _CSSUtils(minify=True)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.one.dispose()
+
+    def test_order(self):
+        from van.static.cdn import _parallel_process
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        input = list(_iter_to_dict([
+            ('tests/example/css/example_imported.css', here + '/example/css/example_imported.css', 'van.static', dist, 'file'),
+            ('tests/example/example.txt', here + '/example/example.txt', 'van.static', dist, 'file'),
+            ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file')]))
+        out = list(_parallel_process(self.one, iter(input), self.pool, 1))
+        self.assertEqual([f['resource_path'] for f in out], [
+            'tests/example/css/example_imported.css',
+            'tests/example/example.txt',
+            'tests/example/css/example.css'])
+        self.assertEqual(out[1]['filesystem_path'], here + '/example/example.txt')
+        f = open(out[2]['filesystem_path'], 'r')
+        try:
+            self.assertEqual(f.read(), '.example{width:80px}')
+        finally:
+            f.close()
+
+    def test_failure(self):
+        from van.static.cdn import _parallel_process
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        input = list(_iter_to_dict([
+            ('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file'),
+            ('tests/example/css/missing.css', here + '/example/css/missing.css', 'van.static', dist, 'file')]))
+        out = _parallel_process(self.one, iter(input), self.pool, 4)
+        try:
+            list(out)
+        except Exception:
+            e = sys.exc_info()[1]
+            self.assertTrue('van.static:tests/example/css/missing.css' in str(e), str(e))
+        else:
+            self.fail('Expected an exception')
+
+
+class TestCache(TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self._tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+
+    def _write(self, name, contents):
+        path = os.path.join(self._tmpdir, name)
+        f = open(path, 'w')
+        try:
+            f.write(contents)
+        finally:
+            f.close()
+        return path
+
+    def _read(self, path):
+        f = open(path, 'r')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_get_store(self):
+        from van.static.cdn import _Cache
+        cache = _Cache(self.cache_dir)
+        source = self._write('source.css', 'a { }')
+        self.assertFalse(cache.get(source, 'minify', os.path.join(self._tmpdir, 'output.css')))
+        cache.store(self._write('output.css', 'a{}'))
+        target = os.path.join(self._tmpdir, 'target.css')
+        self.assertTrue(cache.get(source, 'minify', target))
+        self.assertEqual(self._read(target), 'a{}')
+        # a different description or content is a miss
+        self.assertFalse(cache.get(source, 'other', os.path.join(self._tmpdir, 'other.css')))
+        self._write('source.css', 'b { }')
+        self.assertFalse(cache.get(source, 'minify', os.path.join(self._tmpdir, 'other.css')))
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_not_linked(self):
+        from van.static.cdn import _Cache
+        cache = _Cache(self.cache_dir)
+        source = self._write('source.css', 'a { }')
+        output = os.path.join(self._tmpdir, 'output.css')
+        cache.get(source, 'minify', output)
+        cache.store(self._write('output.css', 'a{}'))
+        target = os.path.join(self._tmpdir, 'target.css')
+        os.utime(output, (1000, 1000))
+        self.assertTrue(cache.get(source, 'minify', target))
+        os.utime(target, (1000, 1000))
+        self.assertTrue(cache.get(source, 'minify', os.path.join(self._tmpdir, 'again.css')))
+        # the output and hits may be published, a hit does not touch them
+        for path in [output, target]:
+            self.assertEqual(os.stat(path).st_mtime, 1000)
+            self.assertEqual(os.stat(path).st_nlink, 1)
+
+    def test_evict(self):
+        from van.static.cdn import _Cache
+        cache = _Cache(self.cache_dir, max_size=6)
+        for i, name in enumerate(['a', 'b', 'c']):
+            source = self._write(name, name)
+            cache.get(source, 'minify', os.path.join(self._tmpdir, name + '.out'))
+            cache.store(self._write(name + '.out', name * 4))
+        # make "a" the least recently used
+        for name, mtime in [('a', 1000), ('b', 3000), ('c', 2000)]:
+            cache.get(os.path.join(self._tmpdir, name), 'minify', os.path.join(self._tmpdir, name + '.hit'))
+            for root, dirs, files in os.walk(self.cache_dir):
+                for f in files:
+                    if self._read(os.path.join(root, f)) == name * 4:
+                        os.utime(os.path.join(root, f), (mtime, mtime))
+        cache.close()
+        remaining = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            remaining.extend([self._read(os.path.join(root, f)) for f in files])
+        self.assertEqual(remaining, ['bbbb'])
+
+    @patch('van.static.cdn._cssutils_process')
+    def test_stage(self, process):
+        from van.static.cdn import _CSSUtils, _Cache
+        here = os.path.dirname(__file__)
+        from van.static.cdn import _get_distribution as get_distribution
+        dist = get_distribution('van.static')
+        def run():
+            one = _CSSUtils(minify=True)
+            one.cache = cache = _Cache(self.cache_dir)
+            try:
+                input = list(_iter_to_dict([('tests/example/css/example.css', here + '/example/css/example.css', 'van.static', dist, 'file')]))
+                out = list(one.process(iter(input)))
+                return cache, self._read(out[0]['filesystem_path'])
+            finally:
+                one.dispose()
+        def minify(source, target, resolve_imports, minify):
+            f = open(target, 'w')
+            f.write('minified')
+            f.close()
+        process.side_effect = minify
+        cache, output = run()
+        self.assertEqual((cache.hits, cache.misses, process.call_count), (0, 1, 1))
+        self.assertEqual(output, 'minified')
+        # the second run does no work
+        cache, output = run()
+        self.assertEqual((cache.hits, cache.misses, process.call_count), (1, 0, 1))
+        self.assertEqual(output, 'minified')
+
+
 class TestFunctional(TestCase):
 
     def setUp(self):
@@ -804,7 +2334,7 @@ class TestFunctional(TestCase):
                 target=target_url,
                 resources=['van.static:tests/example'],
                 args=['export_cmd'])
-        from pkg_resources import get_distribution
+        from van.static.cdn import _get_distribution as get_distribution
         dist = get_distribution('van.static')
         d = self._tmpdir
         self.assertEqual(os.listdir(d), ['van.static'])
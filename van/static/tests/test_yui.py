@@ -1,5 +1,9 @@
+import os
+import sys
 from unittest import TestCase
 
+from mock import patch, Mock
+
 class TestExtractRequires(TestCase):
 
     def test_it(self):
@@ -7,3 +11,383 @@ class TestExtractRequires(TestCase):
         self.assertEqual(
                 _extract_requires("}, '1', { requires: ['yui-base', 'yui-later', 'json', 'io-base'] });"),
                 ['yui-base', 'yui-later', 'json', 'io-base'])
+
+
+class TestLastLine(TestCase):
+
+    def last_line(self, data):
+        from io import BytesIO
+        from van.static.yui import _last_line
+        return _last_line(BytesIO(data))
+
+    def test_last_line(self):
+        self.assertEqual(self.last_line(b"a\nb\n"), b"b")
+        self.assertEqual(self.last_line(b"a\r\n  b \r\n\r\n \n"), b"  b")
+        self.assertEqual(self.last_line(b"only"), b"only")
+        self.assertEqual(self.last_line(b"only\n\n"), b"only")
+        self.assertEqual(self.last_line(b""), None)
+        self.assertEqual(self.last_line(b"\n  \n"), None)
+
+    @patch('van.static.yui._BLOCK_SIZE', 4)
+    def test_blocks(self):
+        # lines longer than a block and blank lines spanning blocks
+        self.assertEqual(self.last_line(b"first\nthe last line\n\n\n\n  \n"), b"the last line")
+        self.assertEqual(self.last_line(b"the only line\r\n"), b"the only line")
+        self.assertEqual(self.last_line(b"ab\r\ncd"), b"cd")
+        self.assertEqual(self.last_line(b"x" * 1000 + b"\n" + b"y" * 1001), b"y" * 1001)
+        self.assertEqual(self.last_line(b"a\n   "), b"a")
+
+    @patch('van.static.yui._BLOCK_SIZE', 16)
+    def test_tail_only(self):
+        from io import BytesIO
+        from van.static.yui import _last_line
+        f = BytesIO(b"x" * 10000 + b"\n}, '1', { requires: ['node'] });\n")
+        read = []
+        original = f.read
+        def counting_read(size=-1):
+            data = original(size)
+            read.append(len(data))
+            return data
+        f.read = counting_read
+        self.assertEqual(_last_line(f), b"}, '1', { requires: ['node'] });")
+        self.assertTrue(sum(read) <= 48, read)
+
+
+class TestModuleGraph(TestCase):
+
+    def graph(self, requires, known=None):
+        from van.static.yui import ModuleGraph
+        modules = {}
+        for name, r in requires.items():
+            modules[name] = {'path': name + '.js', 'requires': r}
+        return ModuleGraph(modules, known)
+
+    def test_load_order(self):
+        graph = self.graph({
+            'a': ['node'],
+            'b': ['a', 'io'],
+            'c': ['b', 'a'],
+            'd': None})
+        self.assertEqual(graph.load_order(['c']), ['a', 'b', 'c'])
+        self.assertEqual(graph.load_order(['d', 'c', 'd']), ['a', 'b', 'c', 'd'])
+        self.assertEqual(graph.load_order(['a']), ['a'])
+        self.assertEqual(graph.cycles, [])
+        self.assertEqual(graph.missing, {'a': ['node'], 'b': ['io']})
+        self.assertRaises(KeyError, graph.load_order, ['node'])
+        # memoized
+        order = graph.load_order(['c', 'd'])
+        self.assertEqual(graph._orders[('c', 'd')], order)
+        order.append('spoiled')
+        self.assertEqual(graph.load_order(['c', 'd']), ['a', 'b', 'c', 'd'])
+
+    def test_cycles(self):
+        graph = self.graph({
+            'x': ['y'],
+            'y': ['x', 'a'],
+            'z': ['z'],
+            'a': [],
+            'b': ['a', 'x']})
+        self.assertEqual(graph.cycles, [['x', 'y'], ['z']])
+        self.assertEqual(graph.load_order(['b']), ['a', 'y', 'x', 'b'])
+
+    def test_known(self):
+        graph = self.graph({'a': ['node', 'nod'], 'b': ['a', 'io']},
+                           known=['node', 'io'])
+        self.assertEqual(graph.missing, {'a': ['nod']})
+
+    def test_deep(self):
+        # no recursion limits
+        requires = {'m0': []}
+        for i in range(1, 5000):
+            requires['m%d' % i] = ['m%d' % (i - 1)]
+        requires['m0'] = ['m4999']
+        graph = self.graph(requires)
+        self.assertEqual(len(graph.cycles), 1)
+        requires['m0'] = []
+        graph = self.graph(requires)
+        order = graph.load_order(['m4999'])
+        self.assertEqual(order[:2], ['m0', 'm1'])
+        self.assertEqual(len(order), 5000)
+
+
+class TestImport(TestCase):
+
+    def test_no_pkg_resources(self):
+        # importing pkg_resources scans all installed distributions, it is
+        # only used on Pythons without importlib.resources.files
+        import os
+        import sys
+        import subprocess
+        import van.static
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(van.static.__file__))))
+        code = "import sys, van.static.yui; print('pkg_resources' in sys.modules)"
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(out.strip(), 'False'.encode('ascii'))
+
+
+class TestFindModules(TestCase):
+
+    def setUp(self):
+        import sys
+        import tempfile
+        self._tmpdir = tempfile.mkdtemp()
+        self.js = os.path.join(self._tmpdir, 'yuitestmodules', 'js')
+        os.makedirs(self.js)
+        open(os.path.join(self._tmpdir, 'yuitestmodules', '__init__.py'), 'w').close()
+        self.write('a.js', "YUI.add('a', function (Y) {\n}, '1', { requires: ['node'] });\n")
+        self.write('b.js', "YUI.add('b', function (Y) {\n}, '1', { requires: ['a', 'io'] });\n\n")
+        self.write('notes.txt', "not a module")
+        sys.path.insert(0, self._tmpdir)
+
+    def tearDown(self):
+        import sys
+        import shutil
+        from van.static import yui
+        yui.stop_watching()
+        sys.path.remove(self._tmpdir)
+        sys.modules.pop('yuitestmodules', None)
+        for cache in [yui._MODULE_CACHE, yui._FILE_CACHE, yui._RESOURCES]:
+            cache.pop('yuitestmodules:js', None)
+        for k in list(yui._GRAPHS):
+            if k[0] == 'yuitestmodules:js':
+                del yui._GRAPHS[k]
+        shutil.rmtree(self._tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.js, name)
+        f = open(path, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        # make sure the modification is seen even on coarse timestamps
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + len(data)))
+
+    def test_find_modules(self):
+        from van.static.yui import find_modules
+        modules = find_modules('yuitestmodules:js')
+        self.assertEqual(modules, {
+            'a': {'path': 'a.js', 'requires': ['node']},
+            'b': {'path': 'b.js', 'requires': ['a', 'io']}})
+        # cached
+        self.write('a.js', "YUI.add('a', function (Y) {\n}, '1', { requires: [] });\n")
+        self.assertTrue(find_modules('yuitestmodules:js') is modules)
+
+    def test_module(self):
+        # resources next to a module which is not a package
+        import sys
+        from van.static import yui
+        open(os.path.join(self._tmpdir, 'yuitestmodules', 'mod.py'), 'w').close()
+        try:
+            modules = yui.find_modules('yuitestmodules.mod:js')
+        finally:
+            sys.modules.pop('yuitestmodules.mod', None)
+            for cache in [yui._MODULE_CACHE, yui._FILE_CACHE, yui._RESOURCES]:
+                cache.pop('yuitestmodules.mod:js', None)
+        self.assertEqual(sorted(modules), ['a', 'b'])
+
+    def test_reload(self):
+        from van.static import yui
+        yui.find_modules('yuitestmodules:js')
+        self.write('a.js', "YUI.add('a', function (Y) {\n}, '1', { requires: ['node', 'json'] });\n")
+        os.remove(os.path.join(self.js, 'b.js'))
+        self.write('c.js', "YUI.add('c', function (Y) {\n}, '1', { requires: ['a'] });\n")
+        parse = Mock(side_effect=yui._parse)
+        with patch('van.static.yui._parse', parse):
+            modules = yui.find_modules('yuitestmodules:js', reload=True)
+            self.assertEqual(modules, {
+                'a': {'path': 'a.js', 'requires': ['node', 'json']},
+                'c': {'path': 'c.js', 'requires': ['a']}})
+            # only the changed files were read
+            self.assertEqual(sorted([c[0][1] for c in parse.call_args_list]),
+                             ['js/a.js', 'js/c.js'])
+            parse.reset_mock()
+            self.assertEqual(yui.find_modules('yuitestmodules:js', reload=True), modules)
+            self.assertFalse(parse.called)
+
+    def test_fail_onerror(self):
+        import warnings
+        from van.static.yui import find_modules
+        self.write('broken.js', "var broken;\n")
+        self.assertRaises(Exception, find_modules, 'yuitestmodules:js')
+        w = warnings.catch_warnings(record=True)
+        caught = w.__enter__()
+        try:
+            warnings.simplefilter('always')
+            modules = find_modules('yuitestmodules:js', reload=True, fail_onerror=False)
+            self.assertEqual(modules['broken'], {'path': 'broken.js', 'requires': None})
+            self.assertEqual(len(caught), 1)
+            # unchanged files are not warned about again, but still raise
+            find_modules('yuitestmodules:js', reload=True, fail_onerror=False)
+            self.assertEqual(len(caught), 1)
+        finally:
+            w.__exit__()
+        self.assertRaises(Exception, find_modules, 'yuitestmodules:js', reload=True)
+
+    def test_find_graph(self):
+        import warnings
+        from van.static.yui import find_graph
+        graph = find_graph('yuitestmodules:js')
+        self.assertEqual(graph.load_order(['b']), ['a', 'b'])
+        self.assertEqual(graph.missing, {'a': ['node'], 'b': ['io']})
+        # built once for unchanged modules
+        self.assertTrue(find_graph('yuitestmodules:js', reload=True) is graph)
+        self.assertRaises(Exception, find_graph, 'yuitestmodules:js', known=['node'])
+        self.assertEqual(find_graph('yuitestmodules:js', known=['node', 'io']).missing, {})
+        self.write('a.js', "YUI.add('a', function (Y) {\n}, '1', { requires: ['b'] });\n")
+        self.assertRaises(Exception, find_graph, 'yuitestmodules:js', reload=True)
+        w = warnings.catch_warnings(record=True)
+        caught = w.__enter__()
+        try:
+            warnings.simplefilter('always')
+            graph = find_graph('yuitestmodules:js', fail_onerror=False)
+        finally:
+            w.__exit__()
+        self.assertEqual(graph.cycles, [['a', 'b']])
+        self.assertEqual(len(caught), 0) # reported when it was built
+
+    def test_embedded(self):
+        from van.static.yui import find_modules
+        self.write('.van.static-yui-modules.json', '{"z": {"path": "z.js", "requires": ["a"]}}')
+        self.assertEqual(find_modules('yuitestmodules:js'), {
+            'z': {'path': 'z.js', 'requires': ['a']}})
+        # the files are scanned when reloading
+        self.assertEqual(sorted(find_modules('yuitestmodules:js', reload=True)), ['a', 'b'])
+
+    def test_load_modules(self):
+        from van.static.yui import find_modules, load_modules
+        path = os.path.join(self._tmpdir, 'modules.json')
+        f = open(path, 'w')
+        try:
+            f.write('{"z": {"path": "z.js", "requires": ["a"]}}')
+        finally:
+            f.close()
+        modules = load_modules('yuitestmodules:js', path)
+        self.assertEqual(modules, {'z': {'path': 'z.js', 'requires': ['a']}})
+        self.assertTrue(find_modules('yuitestmodules:js') is modules)
+
+    @patch('urllib.request.urlopen')
+    def test_load_modules_timeout(self, urlopen):
+        import socket
+        from van.static.yui import load_modules
+        urlopen.side_effect = socket.timeout('timed out')
+        url = 'http://cdn.example.com/path/js/.van.static-yui-modules.json'
+        try:
+            load_modules('yuitestmodules:js', url, timeout=3)
+        except IOError:
+            e = sys.exc_info()[1]
+            self.assertTrue(url in str(e), str(e))
+        else:
+            self.fail('IOError not raised')
+        urlopen.assert_called_once_with(url, timeout=3)
+
+    def test_watch_modules(self):
+        import time
+        from van.static import yui
+        modules = yui.find_modules('yuitestmodules:js', reload=True)
+        yui.watch_modules(0.01)
+        with patch('van.static.yui._scan') as scan:
+            # the directory is not looked at on reload while watching
+            self.assertTrue(yui.find_modules('yuitestmodules:js', reload=True) is modules)
+            self.assertFalse(scan.called)
+        self.write('a.js', "YUI.add('a', function (Y) {\n}, '1', { requires: ['json'] });\n")
+        for i in range(100):
+            modules = yui.find_modules('yuitestmodules:js', reload=True)
+            if modules['a']['requires'] == ['json']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(modules['a']['requires'], ['json'])
+        yui.stop_watching()
+        self.assertTrue(yui._watcher is None)
+
+
+class TestLRUCache(TestCase):
+
+    def test_lru(self):
+        from van.static.yui import _LRUCache
+        cache = _LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        # b was the least recently used
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+
+class TestComboView(TestFindModules):
+
+    def config(self, reload_assets=False):
+        from pyramid.config import Configurator
+        config = Configurator(autocommit=True,
+                              settings={'reload_assets': reload_assets})
+        config.include('van.static.cdn')
+        return config
+
+    def request(self, config, query_string='', **kw):
+        from pyramid.request import Request
+        request = Request.blank('/combo?' + query_string, **kw)
+        request.registry = config.registry
+        return request
+
+    def test_view(self):
+        config = self.config()
+        config.add_yui_combo_view('combo', 'yuitestmodules:js')
+        app = config.make_wsgi_app()
+        request = self.request(config, 'a.js&b.js')
+        response = request.get_response(app)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'application/javascript')
+        self.assertEqual(response.body,
+            b"YUI.add('a', function (Y) {\n}, '1', { requires: ['node'] });\n\n"
+            b"YUI.add('b', function (Y) {\n}, '1', { requires: ['a', 'io'] });\n\n")
+        self.assertTrue(response.etag)
+        self.assertEqual(response.cache_control.max_age, 3600)
+        # not modified
+        request = self.request(config, 'a.js&b.js',
+                               headers={'If-None-Match': '"%s"' % response.etag})
+        self.assertEqual(request.get_response(app).status_int, 304)
+        # unknown or no modules
+        self.assertEqual(self.request(config, 'a.js&../x.js').get_response(app).status_int, 404)
+        self.assertEqual(self.request(config, 'notes.txt').get_response(app).status_int, 404)
+        self.assertEqual(self.request(config).get_response(app).status_int, 404)
+
+    def test_cache(self):
+        from van.static import yui
+        config = self.config(reload_assets=True)
+        config.add_yui_combo_view('combo', 'yuitestmodules:js')
+        app = config.make_wsgi_app()
+        opened = Mock(side_effect=yui._open)
+        with patch('van.static.yui._open', opened):
+            body = self.request(config, 'a.js').get_response(app).body
+            # the modules were parsed and a.js read for the combo
+            self.assertEqual(opened.call_count, 3)
+            self.assertEqual(self.request(config, 'a.js').get_response(app).body, body)
+            self.assertEqual(opened.call_count, 3)
+            # changed files are read again
+            self.write('a.js', "YUI.add('a', function (Y) {\n}, '1', { requires: [] });\n")
+            self.assertNotEqual(self.request(config, 'a.js').get_response(app).body, body)
+
+    def test_combo_url(self):
+        from van.static.yui import combo_url, find_group, _combo_name
+        config = self.config()
+        config.add_static_view('static', 'yuitestmodules:')
+        config.add_yui_combo_view('combo', 'yuitestmodules:js')
+        request = self.request(config)
+        self.assertEqual(combo_url(request, 'yuitestmodules:js', ['b']),
+                         'http://localhost/combo?a.js&b.js')
+        group = find_group(request, 'yuitestmodules:js')
+        self.assertEqual(group['base'], 'http://localhost/static/js/')
+        self.assertEqual(group['comboBase'], 'http://localhost/combo?')
+        self.assertEqual(group['combine'], True)
+        self.assertEqual(group['root'], '')
+        # on a CDN, the combos written by the extraction are used
+        config = self.config()
+        config.add_static_view('http://cdn.example.com/static', 'yuitestmodules:')
+        config.add_yui_combo_view('http://cdn.example.com/js', 'yuitestmodules:js')
+        request = self.request(config)
+        self.assertEqual(combo_url(request, 'yuitestmodules:js', ['b']),
+                         'http://cdn.example.com/static/js/%s' % _combo_name(['a.js', 'b.js']))
+        self.assertFalse('combine' in find_group(request, 'yuitestmodules:js'))
@@ -1,8 +1,25 @@
 """Tools for working with static resources and YUI3."""
+import os
+import sys
+import json
 import warnings
-from pkg_resources import resource_listdir, resource_stream
+import threading
 
+from van.static import _compat
+
+# resource: modules found in it
 _MODULE_CACHE = {}
+# resource: {filename: (key, requires, error)} of the files parsed
+_FILE_CACHE = {}
+# resource: fail_onerror of the last find_modules
+_RESOURCES = {}
+# (resource, known): ModuleGraph of the modules
+_GRAPHS = {}
+_watcher = None
+# written next to the modules by the yui-modules stage of the extraction
+_MODULES_NAME = '.van.static-yui-modules.json'
+# registry key of {resource: route name of its combo view or None}
+_COMBOS = 'van.static.yui.combos'
 
 def _extract_requires(line):
     # EVIL JS introspection
@@ -16,40 +33,355 @@ def _extract_requires(line):
         return None
     return l.replace(' ', '').replace("'", '').replace('"', '').split(',')
 
+def _listdir(pname, path):
+    root = _compat.files(pname)
+    if root is None:
+        from pkg_resources import resource_listdir
+        return resource_listdir(pname, path)
+    return [f.name for f in root.joinpath(path).iterdir()]
+
+def _open(pname, path):
+    root = _compat.files(pname)
+    if root is None:
+        from pkg_resources import resource_stream
+        return resource_stream(pname, path)
+    return root.joinpath(path).open('rb')
+
+_BLOCK_SIZE = 4096
+
+def _last_line(f):
+    """Return the last non-blank line of the binary file ``f``.
+
+    The file is read backwards in blocks from the end, so only its tail is
+    read. Each block is searched once, long lines like those of minified
+    modules take linear time. Returns None if all lines are blank.
+    """
+    f.seek(0, 2)
+    end = f.tell()
+    # blocks of the last line, last first
+    blocks = []
+    while end > 0:
+        start = max(end - _BLOCK_SIZE, 0)
+        f.seek(start)
+        block = f.read(end - start)
+        end = start
+        if not blocks:
+            # trailing blank lines and whitespace
+            block = block.rstrip()
+            if not block:
+                continue
+        i = max(block.rfind(b'\n'), block.rfind(b'\r'))
+        if i >= 0:
+            blocks.append(block[i + 1:])
+            break
+        blocks.append(block)
+    blocks.reverse()
+    return b''.join(blocks) or None
+
+def _scan(pname, path):
+    """Return ``(filename, key)`` for the files of a resource directory.
+
+    ``key`` changes when the file does, it is None when that can not be told
+    without reading the file.
+    """
+    root = _compat.files(pname)
+    if root is not None and isinstance(root, os.PathLike):
+        result = []
+        for entry in os.scandir(os.path.join(root, path)):
+            st = entry.stat()
+            result.append((entry.name, (st.st_mtime, st.st_size)))
+        return result
+    return [(filename, None) for filename in _listdir(pname, path)]
+
+def _requires(f, name):
+    """Return the requires of the open module file ``f`` and an error
+    message."""
+    l = _last_line(f)
+    if l is None:
+        return None, None
+    l = l.decode('utf-8')
+    requires = _extract_requires(l)
+    if requires is None:
+        return None, "could not find requires in %s, last line was: %s" % (name, l)
+    return requires, None
+
+def _parse(pname, filepath):
+    f = _open(pname, filepath)
+    try:
+        return _requires(f, '%s:%s' % (pname, filepath))
+    finally:
+        f.close()
+
+def _from_json(resource, data, fail_onerror):
+    modules = json.loads(data.decode('utf-8'))
+    for name, module in sorted(modules.items()):
+        if module['requires'] is None:
+            msg = "could not find requires in %s/%s" % (resource, module['path'])
+            if fail_onerror:
+                raise Exception(msg)
+            warnings.warn(msg)
+    _MODULE_CACHE[resource] = modules
+    return modules
+
+def _load_embedded(resource, fail_onerror):
+    pname, path = resource.split(':', 1)
+    try:
+        f = _open(pname, '/'.join([path, _MODULES_NAME]))
+    except (IOError, OSError):
+        return None
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    return _from_json(resource, data, fail_onerror)
+
+def load_modules(resource, location, fail_onerror=True, timeout=10):
+    """Load the modules of ``resource`` written by the extraction.
+
+    ``location`` is the URL or the path of the ``.van.static-yui-modules.json``
+    the yui-modules stage wrote next to the modules. ``find_modules`` then
+    returns them instead of scanning the directory, unless reloading. A URL
+    which does not answer within ``timeout`` seconds raises an IOError.
+    """
+    if '://' not in location:
+        f = open(location, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        return _from_json(resource, data, fail_onerror)
+    try:
+        from urllib.request import urlopen
+    except ImportError:
+        #python 2
+        from urllib2 import urlopen
+    try:
+        f = urlopen(location, timeout=timeout)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    except Exception:
+        e = sys.exc_info()[1]
+        raise IOError("Could not load the YUI modules %s: %s" % (location, e))
+    return _from_json(resource, data, fail_onerror)
+
+def _load_modules(resource, fail_onerror):
+    pname, path = resource.split(':', 1)
+    cached = _FILE_CACHE.get(resource, {})
+    files = {}
+    modules = {}
+    for filename, key in sorted(_scan(pname, path)):
+        if filename.startswith('.') or not filename.endswith('.js'):
+            continue
+        entry = cached.get(filename)
+        fresh = entry is None or key is None or entry[0] != key
+        if fresh:
+            requires, error = _parse(pname, '/'.join([path, filename]))
+            entry = (key, requires, error)
+        files[filename] = entry
+        key, requires, error = entry
+        if error is not None:
+            if fail_onerror:
+                raise Exception(error)
+            elif fresh:
+                warnings.warn(error)
+        modules[filename[:-3]] = dict(path=filename, requires=requires)
+    _FILE_CACHE[resource] = files
+    if _MODULE_CACHE.get(resource) == modules:
+        # unchanged, keep the dependency graph built from them
+        return _MODULE_CACHE[resource]
+    _MODULE_CACHE[resource] = modules
+    return modules
+
 def find_modules(resource, reload=False, fail_onerror=True):
-    if not reload:
+    """Return the YUI3 modules in a resource directory.
+
+    The requires of the modules are cached, with ``reload`` only the files
+    which changed since the last call are read again. While ``watch_modules``
+    runs it keeps the cache up to date instead.
+
+    Without ``reload``, modules given to ``load_modules`` or a
+    ``.van.static-yui-modules.json`` in the directory are used instead of
+    reading the files.
+    """
+    _RESOURCES[resource] = fail_onerror
+    if not reload or _watcher is not None:
         cached = _MODULE_CACHE.get(resource, None)
         if cached is not None:
             return cached
-    modules = {}
-    pname, path = resource.split(':', 1)
-    for filename in resource_listdir(pname, path):
-        if filename.startswith('.') or not filename.endswith('.js'):
-            continue
-        module = filename[:-3]
-        filepath = '/'.join([path, filename])
-        file = resource_stream(pname, filepath)
-        try:
-            lines = file.read()
-        finally:
-            file.close()
-        lines = lines.splitlines()
-        lines.reverse()
-        for l in lines:
-            if not l.strip():
+    if not reload:
+        modules = _load_embedded(resource, fail_onerror)
+        if modules is not None:
+            return modules
+    return _load_modules(resource, fail_onerror)
+
+class _Watcher(threading.Thread):
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for resource, fail_onerror in list(_RESOURCES.items()):
+                try:
+                    _load_modules(resource, fail_onerror)
+                except Exception:
+                    # find_modules reloads the resource and raises the error
+                    _MODULE_CACHE.pop(resource, None)
+
+def watch_modules(interval=1.0):
+    """Refresh the modules found by ``find_modules`` in a background thread.
+
+    Every ``interval`` seconds the changed files are read again, so that
+    ``find_modules(reload=True)`` can return the cached modules without
+    looking at the directory on every call.
+    """
+    global _watcher
+    if _watcher is None:
+        _watcher = _Watcher(interval)
+        _watcher.start()
+
+def stop_watching():
+    """Stop the thread started by ``watch_modules``."""
+    global _watcher
+    watcher = _watcher
+    if watcher is not None:
+        _watcher = None
+        watcher.stopped.set()
+        watcher.join()
+
+class ModuleGraph:
+    """The dependencies between the modules of a group.
+
+    ``requires`` maps each module to the modules of the group it requires.
+    Requires of modules outside the group, like the YUI3 core modules, are
+    left to the YUI3 loader. Those not in ``known`` either are listed in
+    ``missing``, all of them if ``known`` is None. ``cycles`` lists the
+    groups of modules which require each other.
+    """
+
+    def __init__(self, modules, known=None):
+        self.modules = modules
+        self.requires = {}
+        self.missing = {}
+        for name, module in modules.items():
+            requires = module['requires'] or ()
+            self.requires[name] = [r for r in requires if r in modules]
+            missing = [r for r in requires if r not in modules
+                       and (known is None or r not in known)]
+            if missing:
+                self.missing[name] = missing
+        self.cycles = self._find_cycles()
+        self._orders = {}
+
+    def _find_cycles(self):
+        # Tarjan's strongly connected components, without recursion
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+        for root in sorted(self.requires):
+            if root in index:
                 continue
-            l = l.decode('utf-8')
-            requires = _extract_requires(l)
-            if requires is None:
-                msg = "could not find requires in %s:%s, last line was: %s" % (pname, filepath, l)
-                if fail_onerror:
-                    raise Exception(msg)
+            work = [(root, iter(self.requires[root]))]
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                name, requires = work[-1]
+                for r in requires:
+                    if r not in index:
+                        index[r] = lowlink[r] = len(index)
+                        stack.append(r)
+                        on_stack.add(r)
+                        work.append((r, iter(self.requires[r])))
+                        break
+                    elif r in on_stack:
+                        lowlink[name] = min(lowlink[name], index[r])
                 else:
-                    warnings.warn(msg)
-            break
-        modules[module] = dict(path=filename, requires=requires)
-    _MODULE_CACHE[resource] = modules
-    return find_modules(resource, reload=False)
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[name])
+                    if lowlink[name] == index[name]:
+                        component = []
+                        while True:
+                            r = stack.pop()
+                            on_stack.discard(r)
+                            component.append(r)
+                            if r == name:
+                                break
+                        if len(component) > 1 or name in self.requires[name]:
+                            cycles.append(sorted(component))
+        return sorted(cycles)
+
+    def load_order(self, entries):
+        """Return the modules of the group needed by ``entries``.
+
+        Modules come after the modules they require, so loading them in
+        this order needs no further work by the YUI3 loader. The orders are
+        computed once for each set of entries.
+        """
+        key = tuple(sorted(set(entries)))
+        order = self._orders.get(key)
+        if order is None:
+            for name in key:
+                if name not in self.requires:
+                    raise KeyError(name)
+            order = []
+            seen = set()
+            for entry in key:
+                if entry in seen:
+                    continue
+                seen.add(entry)
+                work = [(entry, iter(self.requires[entry]))]
+                while work:
+                    name, requires = work[-1]
+                    for r in requires:
+                        if r not in seen:
+                            seen.add(r)
+                            work.append((r, iter(self.requires[r])))
+                            break
+                    else:
+                        work.pop()
+                        order.append(name)
+            self._orders[key] = order
+        return list(order)
+
+def find_graph(resource, reload=False, fail_onerror=True, known=None):
+    """Return the ``ModuleGraph`` of the modules in a resource directory.
+
+    The graph is built again only when the modules found changed. Cycles
+    between modules and, if ``known`` names the modules available outside
+    the group, requires of unknown modules raise an exception unless
+    ``fail_onerror`` is False.
+    """
+    modules = find_modules(resource, reload=reload, fail_onerror=fail_onerror)
+    if known is not None:
+        known = frozenset(known)
+    k = (resource, known)
+    graph = _GRAPHS.get(k)
+    fresh = graph is None or graph.modules is not modules
+    if fresh:
+        graph = ModuleGraph(modules, known)
+        _GRAPHS[k] = graph
+    errors = []
+    for cycle in graph.cycles:
+        errors.append("dependency cycle in %s between: %s" % (resource, ', '.join(cycle)))
+    if known is not None:
+        for name, missing in sorted(graph.missing.items()):
+            errors.append("%s in %s requires unknown modules: %s" % (name, resource, ', '.join(missing)))
+    for msg in errors:
+        if fail_onerror:
+            raise Exception(msg)
+        elif fresh:
+            warnings.warn(msg)
+    return graph
 
 def find_group(request, resource, fail_onerror=True):
     """Return a group for the YU3 loader configuration.
@@ -60,4 +392,125 @@ def find_group(request, resource, fail_onerror=True):
     modules = find_modules(resource, reload=request.registry.settings['reload_assets'], fail_onerror=fail_onerror)
     group = {'base': request.static_url(resource) + '/',
              'modules': modules}
+    route_name = request.registry.get(_COMBOS, {}).get(resource)
+    if route_name is not None:
+        group.update(combine=True,
+                     comboBase=request.route_url(route_name) + '?',
+                     root='')
     return group
+
+def _combo_name(paths):
+    """Return the file name of the combo of module ``paths``."""
+    import hashlib
+    digest = hashlib.sha1('&'.join(paths).encode('utf-8')).hexdigest()
+    return 'combo-%s.js' % digest[:16]
+
+def _combo_paths(graph, entries):
+    return [graph.modules[name]['path'] for name in graph.load_order(entries)]
+
+def combo_url(request, resource, entries, fail_onerror=True):
+    """Return the URL of the modules needed by ``entries`` in one file.
+
+    With a combo view added by ``add_yui_combo_view`` it serves them,
+    otherwise the URL is of the combo written by the extraction with
+    ``--yui-combo``.
+    """
+    graph = find_graph(resource, reload=request.registry.settings['reload_assets'], fail_onerror=fail_onerror)
+    paths = _combo_paths(graph, entries)
+    route_name = request.registry.get(_COMBOS, {}).get(resource)
+    if route_name is None:
+        return request.static_url('%s/%s' % (resource, _combo_name(paths)))
+    return request.route_url(route_name) + '?' + '&'.join(paths)
+
+class _LRUCache:
+    """A mapping keeping the ``size`` most recently used items."""
+
+    def __init__(self, size):
+        from collections import OrderedDict
+        self._size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        self._lock.acquire()
+        try:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+        finally:
+            self._lock.release()
+
+class _ComboView:
+    """Serve the concatenation of the modules listed in the query string.
+
+    The modules are given by their path in the group, as the YUI3 loader
+    does (``combo?a.js&b.js``). Responses are kept in an LRU cache until
+    the files change and carry an ETag.
+    """
+
+    def __init__(self, resource, cache_size, cache_max_age):
+        self.resource = resource
+        self.cache = _LRUCache(cache_size)
+        self.cache_max_age = cache_max_age
+
+    def __call__(self, request):
+        from pyramid.httpexceptions import HTTPNotFound
+        from pyramid.response import Response
+        paths = [p for p in request.query_string.split('&') if p]
+        modules = find_modules(self.resource, reload=request.registry.settings['reload_assets'])
+        available = set([m['path'] for m in modules.values()])
+        if not paths or [p for p in paths if p not in available]:
+            return HTTPNotFound()
+        # the keys of the files change with them on reload
+        files = _FILE_CACHE.get(self.resource, {})
+        key = tuple([(p, files.get(p, (None, ))[0]) for p in paths])
+        cached = self.cache.get(key)
+        if cached is None:
+            import hashlib
+            pname, path = self.resource.split(':', 1)
+            contents = []
+            for p in paths:
+                f = _open(pname, '/'.join([path, p]))
+                try:
+                    contents.append(f.read())
+                finally:
+                    f.close()
+            body = b'\n'.join(contents)
+            cached = (body, hashlib.md5(body).hexdigest())
+            self.cache.put(key, cached)
+        body, etag = cached
+        response = Response(body=body,
+                            content_type='application/javascript',
+                            conditional_response=True)
+        response.etag = etag
+        response.cache_expires(self.cache_max_age)
+        return response
+
+def add_yui_combo_view(config, name, resource, cache_size=128, cache_max_age=3600):
+    """Add a combo view serving modules of ``resource`` concatenated.
+
+    ``find_group`` then configures the YUI3 loader to combine the modules
+    of the group and ``combo_url`` gives URLs to the view. If ``name`` is a
+    URL, the modules are on a CDN and no view is added, ``combo_url`` then
+    gives the URLs of the combos written by the extraction.
+    """
+    combos = config.registry.setdefault(_COMBOS, {})
+    if '://' in name:
+        combos[resource] = None
+        return
+    route_name = 'van.static.yui.combo:%s' % resource
+    config.add_route(route_name, '/' + name.strip('/'))
+    config.add_view(_ComboView(resource, cache_size, cache_max_age),
+                    route_name=route_name)
+    combos[resource] = route_name